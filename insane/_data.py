@@ -22,7 +22,7 @@ Data tables for building systems.
 
 import numpy as np
 
-__all__ = ['CHARGES', 'SOLVENTS', 'APOLARS']
+__all__ = ['CHARGES', 'SOLVENTS', 'SOLVENT_TEMPLATES', 'APOLARS']
 
 # Lists for automatic charge determination
 CHARGES = {
@@ -191,5 +191,13 @@ SOLVENTS = {
 for solvent in ["W", "WN", "NA", "CL", "Mg", "K", "BUT"]:
     SOLVENTS[solvent] = ((solvent, (0, 0, 0)), )
 
+# Solvents as templates for building: a tuple of bead names and an array
+# of bead coordinates, with one row per bead.
+SOLVENT_TEMPLATES = {
+    name: (tuple(bead for bead, _ in beads),
+           np.array([xyz for _, xyz in beads], dtype=float))
+    for name, beads in SOLVENTS.items()
+}
+
 # Apolar amino acids nd stuff for orienting proteins in membrane
 APOLARS = "ALA CYS PHE ILE LEU MET VAL TRP PLM CLR".split()
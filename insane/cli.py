@@ -66,15 +66,18 @@ def main(argv):
      liplist) = core.old_main(**options)
 
     title = core.system_title(membrane, protein, lipids)
-    atoms = protein + membrane + solvent
+    atoms = core.StructureChain(protein, membrane, solvent)
 
     core.write_summary(protein, membrane, solvent)
-    core.write_structure(
-        output=options['output'],
-        title=title,
-        atoms=atoms,
-        box=box,
-    )
+    if not (options['pipeline'] and core.StructureWriter.supports(options['output'])):
+        core.write_structure(
+            output=options['output'],
+            title=title,
+            atoms=atoms,
+            box=box,
+            pool=core.process_pool(options['workers']),
+            molecules=molecules,
+        )
     core.write_top(options['topology'], molecules, title, liplist)
 
     return 0
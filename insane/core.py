@@ -27,17 +27,25 @@ INSANE: A versatile tool for building membranes and/or solvent with proteins.
 import os
 import sys
 import random
+import itertools
 import collections
+
 import numpy as np
 
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
 from simopt import opt_func
 
 from . import lipids
 from .pbc import PBC
+from .spatial import CellList
 from .structure import *
 from .converters import *
 from .constants import d2r
-from ._data import SOLVENTS, CHARGES, APOLARS
+from ._data import SOLVENTS, SOLVENT_TEMPLATES, CHARGES, APOLARS
 from .options import OPTIONS
 
 
@@ -48,12 +56,40 @@ except NameError:
 
 RTOL = 1e-8
 
+# Number of lattice cells per slab when building the solvent in slabs
+SLAB_CELLS = 2**20
+
 # Set the random seed.
 # The seed is set to an arbitary value set in the INSANE_SEED environment
 # variable. If the environment variable is not set, then the system time is
 # used to set the seed.
 random.seed(os.environ.get('INSANE_SEED', None))
 
+# Root of all the random streams of the numpy based builders
+SEED = random.getrandbits(64)
+
+# Stages of the build with their own random streams
+LATTICE_STREAM   = 0  # Order of the lipid positions, per leaflet
+LIPID_STREAM     = 1  # Kicks and rotations of the lipids, per leaflet
+SOLVENT_STREAM   = 3  # Assignment of solvent types and ions to cells
+BLOCK_STREAM     = 4  # Solvent coordinates, per type and slab
+
+
+def random_generator(*key, seed=None):
+    """
+    Return a numpy random generator for the vectorized builders.
+
+    The generator draws from a counter-based (Philox) stream, selected by
+    the key: a stage of the build, followed by e.g. the leaflet, layer or
+    block. The streams only depend on the seed, which defaults to SEED,
+    and on the key, so the numbers drawn do not depend on the order in
+    which the parts are built or on the number of workers.
+    """
+    if seed is None:
+        seed = SEED
+    sequence = np.random.SeedSequence(seed, spawn_key=tuple(int(k) for k in key))
+    return np.random.Generator(np.random.Philox(sequence))
+
 
 def _point(y, phi):
     r = np.sqrt(1-y*y)
@@ -142,14 +178,498 @@ def resize_pbc_for_lipids(pbc, relL, relU, absL, absU,
         pbc.box[:2,:] *= math.sqrt(area_scale)
 
 
+def hole_cells(centers, shape, pbc):
+    """
+    Return the indices of the grid cells, with the lipids at the cell
+    centers, containing the given hole centers (x, y in nm).
+    """
+    nx, ny = shape
+    cells = []
+    for center in centers:
+        if not isinstance(center, (list, tuple)) or len(center) != 2:
+            raise ValueError('The center of a hole is given as x,y in nm '
+                             '(e.g. -hc 3,4), not as {!r}.'.format(center))
+        x, y = center
+        cells.append((int(math.floor(x*nx/pbc.x)), int(math.floor(y*ny/pbc.y))))
+    return cells
+
+
+def hole_mask(shape, shear, centers, radius):
+    """
+    Return a mask of the cells of a lipid grid that lie outside holes.
+
+    The distances are measured in cells, with periodic boundaries. The
+    grid is sheared by *shear* cells in x over its height, like the grid of
+    a hexagonal box. Cells closer than *radius* to any of the centers are
+    inside a hole.
+    """
+    nx, ny = shape
+    lattice = PBC(box=[nx, 0, 0, shear, ny, 0, 0, 0, 1])
+    cells = np.moveaxis(np.indices((nx, ny, 1)), 0, -1)[:, :, 0]
+    mask = np.ones(shape, dtype=bool)
+    for cx, cy in centers:
+        mask &= lattice.distance(cells, (cx, cy, 0)) >= radius
+    return mask
+
+
+def grid_cells(shape, pbc, points):
+    """
+    Return the indices of the cells of a grid spanning the unit cell
+    that contain the given points.
+
+    The points are put in the unit cell before binning them.
+    """
+    nx, ny, nz = shape
+    x, y, z = pbc.wrap(points).T
+    return ((nx*x/pbc.rx).astype(int),
+            (ny*y/pbc.ry).astype(int),
+            (nz*z/pbc.rz).astype(int))
+
+
+def footprint(shape, pbc, coord, sphere):
+    """
+    Return the number of points per cell of a 2D grid spanning the unit
+    cell, for a sphere of points placed on each of the coordinates.
+    """
+    nx, ny = shape
+    points = (coord[:, None, :] + sphere).reshape((-1, 3))
+    # The membrane is at z = 0 here, so the points are only put in the
+    # unit cell in the plane
+    x, y, _ = pbc.wrap(points * (1, 1, 0)).T
+    ix = (nx*x/pbc.rx).astype(int)
+    iy = (ny*y/pbc.ry).astype(int)
+    return np.bincount(ix*ny + iy, minlength=nx*ny).reshape(shape)
+
+
+def label_cells(free):
+    """
+    Return the labels of the connected regions of free cells in a 2D grid,
+    and the number of regions, like scipy.ndimage.label.
+    """
+    if ndimage is not None:
+        return ndimage.label(free)
+
+    # Propagate the lowest cell index over each region, with pointer
+    # jumping to follow the chains of labels
+    labels = np.arange(free.size).reshape(free.shape)
+    while True:
+        new = labels.copy()
+        for a, b in ((np.s_[1:], np.s_[:-1]), (np.s_[:-1], np.s_[1:])):
+            link = free[a] & free[b]
+            new[a] = np.where(link, np.minimum(new[a], labels[b]), new[a])
+            link = free[:, a] & free[:, b]
+            new[:, a] = np.where(link, np.minimum(new[:, a], labels[:, b]), new[:, a])
+        new = new.ravel()[new]
+        if np.array_equal(new, labels):
+            break
+        labels = new
+    regions = np.unique(labels[free])
+    return np.where(free, np.searchsorted(regions, labels) + 1, 0), len(regions)
+
+
+def enclosed(free):
+    """
+    Return a 2D boolean array flagging the free cells of a periodic grid
+    that are enclosed by occupied cells.
+
+    The regions of free cells are joined over the edges of the box. The
+    regions that connect to a periodic image of themselves wrap around the
+    box and form the outside; the other regions are enclosed. If no region
+    wraps around the box, the largest one is taken as the outside.
+    """
+    labels, num = label_cells(free)
+
+    # Links between regions over the edges of the box, with the shift in
+    # box vectors to the image of the linked region
+    links = collections.defaultdict(list)
+    for last, first, shift in ((labels[-1], labels[0], (1, 0)),
+                               (labels[:, -1], labels[:, 0], (0, 1))):
+        both = (last > 0) & (first > 0)
+        for a, b in set(zip(last[both].tolist(), first[both].tolist())):
+            links[a].append((b, shift))
+            links[b].append((a, (-shift[0], -shift[1])))
+
+    # Walk over the linked regions, keeping track of the image reached
+    group = np.arange(num + 1)
+    wraps = np.zeros(num + 1, dtype=bool)
+    image = {}
+    for start in links:
+        if start in image:
+            continue
+        image[start] = (0, 0)
+        stack = [start]
+        while stack:
+            a = stack.pop()
+            for b, (dx, dy) in links[a]:
+                shifted = (image[a][0] + dx, image[a][1] + dy)
+                if b not in image:
+                    group[b] = start
+                    image[b] = shifted
+                    stack.append(b)
+                elif image[b] != shifted:
+                    wraps[start] = True
+
+    groups = group[labels]
+    outside = wraps[groups]
+    if free.any() and not outside.any():
+        sizes = np.bincount(groups[free])
+        outside = groups == sizes.argmax()
+
+    return free & ~outside
+
+
+def kernel_cells(shape, pbc, coord, kernel):
+    """
+    Return the flat indices of the cells of a grid spanning the unit cell
+    that are hit by a kernel placed on each of the coordinates.
+    """
+    points = (coord[:, None, :] + kernel).reshape((-1, 3))
+    cells = grid_cells(shape, pbc, points)
+    return np.unique(np.ravel_multi_index(cells, shape, mode='wrap'))
+
+
+def grid_columns(shape, pbc, coord, kernel=np.zeros((1, 3)), margin=1, close=False):
+    """
+    Return a 2D boolean array flagging the columns of a grid spanning the
+    unit cell that are hit by a kernel placed on the coordinates, extended
+    by a margin of cells. With *close*, the columns are shrunk by the same
+    margin afterwards, which only fills the gaps between the hits.
+    """
+    columns = np.zeros(shape[:2], dtype=bool)
+    columns.flat[kernel_cells(shape[:2] + (1,), pbc, coord, kernel)] = True
+    for axis in (0, 1):
+        for _ in range(margin):
+            columns |= np.roll(columns, 1, axis) | np.roll(columns, -1, axis)
+    if close:
+        for axis in (0, 1):
+            for _ in range(margin):
+                columns &= np.roll(columns, 1, axis) & np.roll(columns, -1, axis)
+    return columns
+
+
+def profile_exclusion(grid, pbc, coord, kernel, columns, pool=None):
+    """
+    Flag cells in the given columns of a grid, based on the z-profile of a
+    flat membrane.
+
+    The kernel placed on the coordinates gives the hits per grid layer.
+    Layers in which every column is hit are flagged entirely in the given
+    columns. The coverage of a layer is checked kernel point by kernel
+    point, stopping as soon as all columns are hit. In the other layers,
+    the kernel points ending up in those layers are placed one by one.
+    The grid is changed **in place**.
+    """
+    nz = grid.shape[2]
+    if not columns.any():
+        return grid
+    # Insane membranes have few distinct bead heights
+    heights, inverse, counts = np.unique(coord[:, 2], return_inverse=True,
+                                         return_counts=True)
+    groups = [coord[inverse.ravel() == height] for height in range(len(heights))]
+    layers = (nz*((heights[:, None] + kernel[:, 2]) % pbc.z)/pbc.rz).astype(int)
+    hits = np.bincount(layers.ravel(), np.repeat(counts, len(kernel)), minlength=nz)
+    # A layer with fewer hits than columns can not be filled
+    full = hits >= columns.sum()
+    for layer in np.flatnonzero(full):
+        covered = ~columns
+        for height, point in zip(*np.nonzero(layers == layer)):
+            cells = kernel_cells(columns.shape + (1,), pbc, groups[height],
+                                 kernel[point:point+1])
+            covered.flat[cells] = True
+            if covered.all():
+                break
+        else:
+            full[layer] = False
+    grid[:, :, full] &= ~columns[:, :, None]
+    for height, layer in enumerate(layers):
+        partial = ~full[layer]
+        if partial.any():
+            stamp_kernel(grid, pbc, groups[height], kernel[partial], pool=pool)
+    return grid
+
+
+def stamp_kernel(grid, pbc, coord, kernel, chunk=50000, pool=None):
+    """
+    Flag the cells of a grid spanning the unit cell that are hit by a kernel.
+
+    The kernel (a set of offsets, like points on a sphere) is placed on each
+    of the coordinates and the cells of the resulting points are set to
+    False. The grid is changed **in place**. The coordinates are processed
+    in chunks to keep the size of the temporary arrays bounded; given a
+    process pool, the chunks are spread over its workers.
+    """
+    chunks = [coord[start:start+chunk] for start in range(0, len(coord), chunk)]
+    args = (itertools.repeat(grid.shape), itertools.repeat(pbc),
+            chunks, itertools.repeat(kernel))
+    if pool is not None and len(chunks) > 1:
+        for cells in pool.map(kernel_cells, *args):
+            grid.flat[cells] = False
+    else:
+        for cells in map(kernel_cells, *args):
+            grid.flat[cells] = False
+    return grid
+
+
+def rotate_random_quaternions(template, positions, rng):
+    """
+    Place a randomly rotated copy of a template on each of the positions.
+
+    A random unit quaternion is drawn for every position and all copies are
+    rotated at once. Returns an array with shape (positions, beads, 3).
+    """
+    u, v, w = rng.random((3, len(positions)))
+    v, w = 2*np.pi*v, 2*np.pi*w
+    s, t = np.sqrt(1-u), np.sqrt(u)
+    qw, q = s*np.sin(v), np.stack((s*np.cos(v), t*np.sin(w), t*np.cos(w)), axis=1)
+    qq = qw*qw - (q*q).sum(axis=1)
+    qp = 2*np.dot(q, template.T)
+    return (positions[:, None, :]
+            + qp[:, :, None]*q[:, None, :]
+            + qq[:, None, None]*template
+            + qw[:, None, None]*np.cross(q[:, None, :], template))
+
+
+def ragged_arange(starts, sizes):
+    """
+    Return the concatenated ranges [start, start+size) for all pairs.
+    """
+    sizes = np.asarray(sizes)
+    offsets = np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return np.repeat(starts, sizes) + np.arange(sizes.sum()) - offsets
+
+
+def closest_contact(coord, molecules, box, cutoff):
+    """
+    Return the shortest distance between beads of different molecules,
+    with periodic boundary conditions, or *cutoff* if no beads are closer.
+    """
+    i, j, d2 = CellList(coord, cutoff, box).pairs(coord)
+    d2 = d2[molecules[i] != molecules[j]]
+    return np.sqrt(d2.min()) if len(d2) else cutoff
+
+
+def boundary_overlaps(coord, molecules, box, cutoff):
+    """
+    Return a mask of the molecules to remove because they are closer than
+    *cutoff* to another molecule across the periodic boundaries.
+
+    Beads that are close without crossing a boundary are not considered,
+    as they come from the same, equilibrated, solvent box. Of each pair of
+    overlapping molecules, the one with the higher index is removed.
+    """
+    i, j, _ = CellList(coord, cutoff, box).pairs(coord)
+    direct = ((coord[i] - coord[j])**2).sum(axis=1)
+    cross = (molecules[i] < molecules[j]) & (direct >= cutoff**2)
+    removed = np.zeros(molecules.max() + 1 if len(molecules) else 0, dtype=bool)
+    for a, b in sorted(set(zip(molecules[i][cross].tolist(), molecules[j][cross].tolist()))):
+        if not removed[a]:
+            removed[b] = True
+    return removed
+
+
+def tile_solvent_box(pbc, grid, solbox, distance=0.5):
+    """
+    Tile a (pre-equilibrated) solvent box over the unit cell.
+
+    The box is repeated over the rectangular brick corresponding to the
+    unit cell, and the molecules with their first bead inside the brick are
+    kept. Molecules with any bead in a cell of *grid* flagged as occupied
+    are removed. Where the tiles are cut at the cell boundary, molecules
+    that come closer to the periodic images of others than the molecules
+    in the solvent box do (searched up to *distance*) are removed as well.
+
+    Returns the residue names and sizes of the molecules that are kept,
+    and the names and coordinates of their beads.
+    """
+    size = np.diag(np.array(solbox.box, dtype=float).reshape((3, 3)))
+    if not np.all(size > 0):
+        raise ValueError('The solvent box needs a rectangular box with a '
+                         'non-zero size.')
+
+    # Split the box in molecules
+    starts = solbox.residues
+    sizes = np.diff(np.append(starts, len(solbox)))
+    resnames = np.array(solbox.resnames.map(str.strip)[starts].tolist())
+    atnames = np.array(solbox.names.map(str.strip).tolist())
+
+    # Put the molecules in the box, based on their first bead
+    coord = solbox.coord - np.repeat(np.floor(solbox.coord[starts]/size)*size,
+                                     sizes, axis=0)
+
+    # Tile the box over the brick and keep the molecules starting inside
+    brick = np.array((pbc.x, pbc.y, pbc.z))
+    shifts = np.indices(np.ceil(brick/size).astype(int)).reshape((3, -1)).T * size
+    tile, mol = np.nonzero(np.all(coord[starts] + shifts[:, None, :] < brick, axis=2))
+    beads = ragged_arange(starts[mol], sizes[mol])
+    tiled = coord[beads] + shifts[np.repeat(tile, sizes[mol])]
+
+    # Remove the molecules overlapping with protein and/or membrane
+    cells = (grid.shape * pbc.wrap(tiled) / (pbc.rx, pbc.ry, pbc.rz)).astype(int)
+    free = grid[cells[:, 0], cells[:, 1], cells[:, 2]]
+    free = np.logical_and.reduceat(free, np.cumsum(sizes[mol]) - sizes[mol])
+
+    # Remove the molecules overlapping with others across the cell boundary
+    cutoff = closest_contact(coord, np.repeat(np.arange(len(starts)), sizes),
+                             np.diag(size), min(distance, size.min()))
+    kept = np.repeat(free, sizes[mol])
+    molecules = np.repeat(np.arange(free.sum()), sizes[mol[free]])
+    free[free] = ~boundary_overlaps(tiled[kept], molecules, pbc.box, cutoff)
+    keep = np.repeat(free, sizes[mol])
+
+    return resnames[mol[free]], sizes[mol[free]], atnames[beads[keep]], tiled[keep]
+
+
+def determine_ion_numbers(options, charge, solnames, npositions):
+    """
+    Determine the number of sodium and chloride ions to add, given the
+    number of positions available for solvent.
+    """
+    nna, ncl = 0, 0
+    if options["salt"]:
+
+        # If the concentration is set negative, set the charge to zero
+        if options["salt"].startswith("-"):
+            charge = 0
+            options["salt"] = -float(options["salt"])
+        else:
+            options["salt"] = float(options["salt"])
+
+        # Determine charge to use, either determined or given on command line
+        if options["charge"] != "0":
+            charge = (options["charge"] != "auto") and int(options["charge"]) or charge
+        else:
+            charge = 0
+
+        # Determine number of sodium and chloride to add
+        concentration = options["salt"]
+        nsol = ("SPC" in solnames and 1 or 4)*npositions
+        ncl  = max(max(0, charge), int(.5+.5*(concentration*nsol/(27.7+concentration)+charge)))
+        nna  = ncl - charge
+    return nna, ncl
+
+
+def solvent_block(resn, atnames, coord, resi=0):
+    """
+    Return a Structure for a block of solvent molecules of one type.
+
+    The coordinates are given for all beads, molecule after molecule, and
+    the residue numbers start after *resi*.
+    """
+    num = len(coord) // len(atnames)
+    names = Categorical(codes=np.tile(np.arange(len(atnames)), num), table=atnames)
+    resnames = Categorical(codes=np.zeros(num*len(atnames)), table=[resn])
+    resids = np.repeat(np.arange(resi+1, resi+num+1), len(atnames))
+    return Structure.from_columns(names, resnames, resids, coord)
+
+
+def build_solvent_block(labels, z, label, resn, atnames, template,
+                        spacing, kick, resi, key, seed=None):
+    """
+    Return the solvent of one type in a slab of the lattice as a Structure.
+
+    The slab of cell labels starts at layer *z* of the lattice. The random
+    numbers are drawn from the stream for the given key and seed.
+    """
+    cells = np.argwhere(labels == label)
+    cells[:, 2] += z
+    rng = random_generator(*key, seed=seed)
+    # Center of the cell with a random kick from the lower corner
+    positions = (cells + 0.5 + rng.random(cells.shape)*kick) * spacing
+    if len(template) > 1:
+        positions = rotate_random_quaternions(template, positions, rng)
+    return solvent_block(resn, list(atnames), positions.reshape((-1, 3)), resi)
+
+
+class SolventLattice(object):
+    """
+    Solvent placed on a lattice, built one block at a time.
+
+    The solvent types are assigned to the cells of the lattice up front, as
+    labels. The coordinates are only generated when going over the blocks,
+    one solvent type and one z-slab of cells at a time, so the memory used
+    is bounded by the size of a slab. Each block draws its random numbers
+    from its own stream, so any block can be built again, by any worker,
+    with the same outcome.
+    """
+
+    def __init__(self, labels, spacing, names, kick, resi=0, layers=None, pool=None):
+        self.labels  = labels
+        self.spacing = np.array(spacing)
+        self.names   = list(names)
+        self.kick    = kick
+        self.resi    = resi
+        self.layers  = layers or labels.shape[2]
+        self.pool    = pool
+        self.seed    = SEED
+        self.templates = [SOLVENT_TEMPLATES.get(resn, ((resn,), np.zeros((1, 3))))
+                          for resn in self.names]
+
+        # Number of molecules of each type per slab
+        self.counts = np.array([
+            np.bincount(labels[:, :, z:z+self.layers].ravel() + 1,
+                        minlength=len(self.names)+1)[1:]
+            for z in range(0, labels.shape[2], self.layers)
+        ]).reshape((-1, len(self.names)))
+
+    def __len__(self):
+        beads = [len(atnames) for atnames, _ in self.templates]
+        return int(np.dot(self.counts.sum(axis=0), beads))
+
+    def __iter__(self):
+        offset = 0
+        for block in self.blocks():
+            for atom in block:
+                yield (offset + atom[0],) + atom[1:]
+            offset += len(block)
+
+    def jobs(self):
+        """
+        Generate the arguments to build_solvent_block for all the blocks.
+        """
+        resi = self.resi
+        for t, (resn, (atnames, template)) in enumerate(zip(self.names, self.templates)):
+            for k, z in enumerate(range(0, self.labels.shape[2], self.layers)):
+                if not self.counts[k, t]:
+                    continue
+                yield (self.labels[:, :, z:z+self.layers], z, t, resn, atnames,
+                       template, self.spacing, self.kick, resi,
+                       (BLOCK_STREAM, t, k), self.seed)
+                resi += self.counts[k, t]
+
+    def blocks(self):
+        """
+        Generate the solvent as Structure instances, per type and slab.
+
+        Given a process pool, the blocks are built by its workers, keeping
+        a limited number of blocks ahead of the one yielded.
+        """
+        if self.pool is None:
+            for job in self.jobs():
+                yield build_solvent_block(*job)
+            return
+        pending = collections.deque()
+        for job in self.jobs():
+            pending.append(self.pool.submit(build_solvent_block, *job))
+            if len(pending) > 2*self.pool.workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+    def build(self):
+        """
+        Return the complete solvent as a single Structure.
+        """
+        return Structure.concatenate(self.blocks())
+
+
 def setup_solvent(pbc, protein, membrane, options):
     # Charge of the system so far
 
-    if not options["solvent"]:
+    if not (options["solvent"] or options["solbox"]):
         return Structure(), []
 
     solv = options["solvent"]
-    charge = membrane.charge + protein.charge
+    charge = StructureChain(membrane, protein).charge
 
     # Set up a grid
     d        = 1/options["soldiam"]
@@ -165,51 +685,89 @@ def setup_solvent(pbc, protein, membrane, options):
 
     zshift   = 0
     if membrane:
-        memz   = [i[2] for i in membrane.coord]
-        midz   = (max(memz)+min(memz))/2
+        memz   = membrane.coord[:, 2]
+        midz   = (memz.max()+memz.min())/2
         hz     = int(nz*midz/pbc.z)  # Grid layer in which the membrane is located
         zshift = (hz+0.5)*nz - midz # Shift of membrane middle to center of grid layer
 
     # Initialize a grid of solvent, spanning the whole cell
     # Exclude all cells within specified distance from membrane center
-    grid   = [[[i < hz-excl or i > hz+excl for i in range(nz)] for j in range(ny)] for i in range(nx)]
-
-    # Flag all cells occupied by protein or membrane
-    for coord in (protein+membrane).coord:
-        for x, y, z in coord + options["lipradius"] * pointsOnSphere(options["lipdensity"]):
-            if z >= pbc.z:
-                x -= pbc.box[2,0]
-                y -= pbc.box[2,1]
-                z -= pbc.box[2,2]
-            if z < 0:
-                x += pbc.box[2,0]
-                y += pbc.box[2,1]
-                z += pbc.box[2,2]
-            if y >= pbc.y:
-                x -= pbc.box[1,0]
-                y -= pbc.box[1,1]
-            if y < 0:
-                x += pbc.box[1,0]
-                y += pbc.box[1,1]
-            if x >= pbc.x:
-                x -= pbc.box[0,0]
-            if x < 0:
-                x += pbc.box[0,0]
-            grid[int(nx*x/pbc.rx)][int(ny*y/pbc.ry)][int(nz*z/pbc.rz)] = False
-
-    ##-T grid should be a wrapper around a numpy.ndarray
-    # Set the center for each solvent molecule
-    kick = options["solrandom"]
-    grid = [ (random.random(), (i+0.5+random.random()*kick)*dx, (j+0.5+random.random()*kick)*dy, (k+0.5+random.random()*kick)*dz)
-             for i in range(nx) for j in range(ny) for k in range(nz) if grid[i][j][k] ]
-
-    # Sort on the random number
-    grid.sort()
-
-    # 'grid' contains all positions on which a solvent molecule can be placed.
-    # The number of positions is taken as the basis for determining the salt concentration.
+    layers = np.arange(nz)
+    grid   = np.ones((nx, ny, nz), dtype=bool)
+    grid[:, :, (layers >= hz-excl) & (layers <= hz+excl)] = False
+
+    rng = random_generator(SOLVENT_STREAM)
+    pool = process_pool(options["workers"])
+
+    # Flag all cells occupied by protein or membrane.
+    # Away from solutes the membrane is flat, and the cells occupied follow
+    # from the z-profile of the membrane. Only the beads in and around the
+    # columns with solute are placed one by one.
+    kernel = options["lipradius"] * pointsOnSphere(options["lipdensity"])
+    beads = protein.coord
+    if membrane:
+        solute = np.zeros((nx, ny), dtype=bool)
+        if protein:
+            solute = grid_columns(grid.shape, pbc, protein.coord, kernel)
+        # Membrane beads next to a column that is not flat membrane, like
+        # at the edge of a hole or a disc, are also placed one by one
+        flat = grid_columns(grid.shape, pbc, membrane.coord, close=True) & ~solute
+        edge = ~flat
+        for axis in (0, 1):
+            edge = edge | np.roll(edge, 1, axis) | np.roll(edge, -1, axis)
+        ix, iy, _ = grid_cells((nx, ny, 1), pbc, membrane.coord)
+        near = edge[ix % nx, iy % ny]
+        profile_exclusion(grid, pbc, membrane.coord[~near], kernel, flat,
+                          pool=pool)
+        beads = np.concatenate((beads, membrane.coord[near]))
+    stamp_kernel(grid, pbc, beads, kernel, pool=pool)
+
+    resi = 0
+    if protein:
+        resi = int(protein.resids[-1])
+    if membrane:
+        resi = int(membrane.resids[-1])
+
+    if options["solbox"]:
+        # Tile the given solvent box and replace molecules by ions
+        molnames, molsizes, atnames, coord = tile_solvent_box(
+            pbc, grid, Structure(options["solbox"]), options["soldiam"])
+        solnames = list(collections.OrderedDict.fromkeys(molnames))
+        nna, ncl = determine_ion_numbers(options, charge, solnames, len(molnames))
+        if nna + ncl > len(molnames):
+            raise ValueError('Not enough solvent molecules to place the ions.')
+        first = np.cumsum(molsizes) - molsizes
+        chosen = rng.permutation(len(molnames))[:nna+ncl]
+        ions = np.zeros(len(molnames), dtype=bool)
+        ions[chosen] = True
+        positions = coord[first[chosen]]
+
+        # Each block of solvent is a residue name with the number of
+        # molecules, the bead names of one molecule and the coordinates.
+        blocks = []
+        for resn in solnames:
+            j = np.flatnonzero(molnames == resn)[0]
+            names = list(atnames[first[j]:first[j]+molsizes[j]])
+            mols = (molnames == resn) & ~ions
+            beads = ragged_arange(first[mols], molsizes[mols])
+            blocks.append((resn, mols.sum(), names, coord[beads]))
+        if nna:
+            blocks.append(("NA", nna, ["NA"], positions[:nna]))
+            solv.append("NA")
+        if ncl:
+            blocks.append(("CL", ncl, ["CL"], positions[nna:]))
+            solv.append("CL")
+
+        parts = []
+        for resn, num, names, coord in blocks:
+            parts.append(solvent_block(resn, names, coord, resi))
+            resi += num
+        return Structure.concatenate(parts), [(resn, num) for resn, num, _, _ in blocks]
+
+    # The number of free cells is taken as the basis for determining the salt concentration.
     # This is fine for simple salt solutions, but may not be optimal for complex mixtures
     # (like when mixing a 1M solution of this with a 1M solution of that
+    nfree = int(grid.sum())
 
     # First get names and relative numbers for each solvent
     solnames, solabs, solnums = list(zip(*solv))
@@ -217,33 +775,12 @@ def setup_solvent(pbc, protein, membrane, options):
     totS       = float(sum(solnums))
 
     # Set the number of ions to add
-    nna, ncl = 0, 0
-    if options["salt"]:
-
-        # If the concentration is set negative, set the charge to zero
-        if options["salt"].startswith("-"):
-            charge = 0
-            options["salt"] = -float(options["salt"])
-        else:
-            options["salt"] = float(options["salt"])
-
-        # Determine charge to use, either determined or given on command line
-        if options["charge"] != "0":
-            charge = (options["charge"] != "auto") and int(options["charge"]) or charge
-        else:
-            charge = 0
-
-        # Determine number of sodium and chloride to add
-        concentration = options["salt"]
-        nsol = ("SPC" in solnames and 1 or 4)*len(grid)
-        ncl  = max(max(0, charge), int(.5+.5*(concentration*nsol/(27.7+concentration)+charge)))
-        nna  = ncl - charge
+    nna, ncl = determine_ion_numbers(options, charge, solnames, nfree)
 
     # Correct number of grid cells for placement of solvent
-    ngrid   = len(grid) - nna - ncl
+    ngrid   = nfree - nna - ncl
     num_sol = [int(ngrid*i/totS) for i in solnums]
 
-
     # Add salt to solnames and num_sol
     if nna:
         solnames.append("NA")
@@ -254,42 +791,87 @@ def setup_solvent(pbc, protein, membrane, options):
         num_sol.append(ncl)
         solv.append("CL")
 
+    # Assign the solvent types to the free cells in random order.
+    # Cells that are left over are labeled -1.
+    labels = np.repeat(np.arange(len(num_sol), dtype=np.int8), num_sol)
+    labels = np.append(labels, np.full(nfree - len(labels), -1, dtype=np.int8))
+    rng.shuffle(labels)
+    cells = np.full(grid.shape, -1, dtype=np.int8)
+    cells[grid] = labels
 
-    # Names and grid positions for solvent molecules
-    solvent    = list(zip([s for i, s in zip(num_sol, solnames) for j in range(i)], grid))
+    # The slabs do not depend on the number of workers, and neither does
+    # the outcome.
+    layers = max(1, SLAB_CELLS // (nx*ny))
+    solvent = SolventLattice(cells, (dx, dy, dz), solnames, options["solrandom"],
+                             resi, layers, pool)
+    if not options["stream"]:
+        solvent = solvent.build()
+
+    return solvent, list(zip(solnames, num_sol))
 
-    # Build the solvent
-    resi = 0
-    if protein:
-        resi = protein.atoms[-1][2]
-    if membrane:
-        resi = membrane.atoms[-1][2]
-    sol = Structure()
-    solcoord = []
-    for resn, (rndm, x, y, z) in solvent:
-        resi += 1
-        solmol = SOLVENTS.get(resn)
-        if solmol and len(solmol) > 1:
-            # Random rotation (quaternion)
-            u,  v,  w       = random.random(), 2*np.pi*random.random(), 2*np.pi*random.random()
-            s,  t           = np.sqrt(1-u), np.sqrt(u)
-            qw, qx, qy, qz  = s*np.sin(v), s*np.cos(v), t*np.sin(w), t*np.cos(w)
-            qq              = qw*qw-qx*qx-qy*qy-qz*qz
-            for atnm, (px, py, pz) in solmol:
-                qp = 2*(qx*px + qy*py + qz*pz)
-                rx = x + qp*qx + qq*px + qw*(qy*pz-qz*py)
-                ry = y + qp*qy + qq*py + qw*(qz*px-qx*pz)
-                rz = z + qp*qz + qq*pz + qw*(qx*py-qy*px)
-                sol.atoms.append((atnm, resn, resi, 0, 0, 0))
-                solcoord.append((rx, ry, rz))
-        else:
-            sol.atoms.append((solmol and solmol[0][0] or resn,
-                              resn, resi,
-                              0, 0, 0))
-            solcoord.append((x, y, z))
-    sol.coord = solcoord
 
-    return sol, list(zip(solnames, num_sol))
+def build_leaflet(leaflet, lipnames, positions, lipd, lipdx, lipdy,
+                  liplist, options, rng, resi=0):
+    """
+    Return a Structure with the lipids of one leaflet.
+
+    The lipids are built per type: the template of each lipid type is
+    rotated, kicked and put at the grid positions of all the lipids of that
+    type at once. The lipids are kept in the order given, with the residue
+    numbers starting after *resi*.
+    """
+    kick    = options["randkick"]
+    inshift = options["indist"] / 2
+    lipnames = np.array(lipnames, dtype=object)
+    positions = np.array(positions, dtype=float).reshape((-1, 2))
+
+    # Fetch the templates, with the atom list and x, y, z coordinates
+    templates = {}
+    for lipid in set(lipnames.tolist()):
+        try:
+            at, xx, az = liplist[lipid].compiled(diam=lipd)
+        except KeyError as e:
+            print(f"ERROR lipid name {e.args[0]} not found in database check lipids.dat, included mol files or specified definition strings")
+            raise e
+        # The z-coordinates are spaced at 0.3 nm,
+        # starting with the first bead at 0.15 nm
+        templates[lipid] = (at, xx, leaflet*(inshift + az)*options["beaddist"])
+
+    # Lay out the beads of all lipids, in order
+    sizes  = np.array([len(templates[lipid][0]) for lipid in lipnames.tolist()], dtype=int)
+    starts = np.cumsum(sizes) - sizes
+    coord  = np.zeros((sizes.sum(), 3))
+
+    for lipid, (at, xx, az) in sorted(templates.items()):
+        idx = np.nonzero(lipnames == lipid)[0]
+        kicks = kick*rng.random((2, len(idx), len(at)))
+        pos = positions[idx]
+        if options["norotate"]:
+            nx = (pos[:, 0] + lipdx/2)[:, None] + kicks[0]
+            ny = (pos[:, 1] + lipdy/2)[:, None] + kicks[1]
+        else:
+            # Set the random rotation for each lipid
+            rangle = 2*rng.random(len(idx))*np.pi
+            rcos   = np.cos(rangle)[:, None]
+            rsin   = np.sin(rangle)[:, None]
+            nx = xx[:, 0]*(rcos*lipdx*2/3) + xx[:, 1]*(-(rsin*lipdy*2/3))
+            ny = xx[:, 0]*(rsin*lipdx*2/3) + xx[:, 1]*(rcos*lipdy*2/3)
+            nx = nx + pos[:, 0, None] + lipdx/2 + kicks[0]
+            ny = ny + pos[:, 1, None] + lipdy/2 + kicks[1]
+        beads = ragged_arange(starts[idx], sizes[idx])
+        coord[beads, 0] = nx.ravel()
+        coord[beads, 1] = ny.ravel()
+        coord[beads, 2] = np.tile(az, len(idx))
+
+    # Atom names per lipid type, with the lipid type as residue name
+    table = sorted(templates)
+    offsets = np.cumsum([0] + [len(templates[lipid][0]) for lipid in table])
+    types = np.searchsorted(table, lipnames)
+    names = Categorical(codes=ragged_arange(offsets[types], sizes),
+                        table=[name for lipid in table for name in templates[lipid][0]])
+    resnames = Categorical(codes=np.repeat(types, sizes), table=table)
+    resids = np.repeat(np.arange(resi+1, resi+len(lipnames)+1), sizes)
+    return Structure.from_columns(names, resnames, resids, coord)
 
 
 def setup_membrane(pbc, protein, lipid, options):
@@ -332,9 +914,7 @@ def setup_membrane(pbc, protein, lipid, options):
         q = not q
 
     lo_lipdx    = pbc.x/lo_lipids_x
-    lo_rlipx    = list(range(lo_lipids_x))
     lo_lipdy    = pbc.y/lo_lipids_y
-    lo_rlipy    = list(range(lo_lipids_y))
     
     if options["uparea"]:
         lipd = up_lipd
@@ -350,42 +930,12 @@ def setup_membrane(pbc, protein, lipid, options):
         q = not q
 
     up_lipdx    = pbc.x/up_lipids_x
-    up_rlipx    = list(range(up_lipids_x))
     up_lipdy    = pbc.y/up_lipids_y
-    up_rlipy    = list(range(up_lipids_y))
 
     # Set up grids to check where to place the lipids
-    grid_lo = [[0 for j in lo_rlipy] for i in lo_rlipx]
-    grid_up = [[0 for j in up_rlipy] for i in up_rlipx]
-
-    ## NEW GRID
-    lo_gx = slice(0, pbc.x, int(pbc.x/lo_lipd + 0.5)*1j)
-    lo_gy = slice(0, pbc.x, int(pbc.x/lo_lipd + 0.5)*1j)
-    up_gx = slice(0, pbc.x, int(pbc.x/up_lipd + 0.5)*1j)
-    up_gy = slice(0, pbc.x, int(pbc.x/up_lipd + 0.5)*1j)
-    grid_l = np.mgrid[lo_gx, lo_gy][:,:-1,:-1].reshape((2,-1)).T
-    grid_u = np.mgrid[up_gx, up_gy][:,:-1,:-1].reshape((2,-1)).T
-    # If there is a protein, mark the corresponding POINTS as occupied
-    occupied_lo = np.zeros(grid_l.shape[0])
-    occupied_up = np.zeros(grid_u.shape[0])
-    if protein:
-        upmask = (protein.coord[:,2] <  2.4) & (protein.coord[:,2] > 0)
-        lomask = (protein.coord[:,2] > -2.4) & (protein.coord[:,2] < 0)
-        occupied_lo += occupancy(grid_l, protein.coord[lomask,:2], lo_lipd)
-        occupied_up += occupancy(grid_u, protein.coord[upmask,:2], up_lipd)
-        maxd = max(occupied_lo.max(), occupied_up.max())
-        if maxd:
-            occupied_up = (occupied_up/maxd) > options["fudge"]
-            occupied_lo = (occupied_lo/maxd) > options["fudge"]
-
-    #print(absU, sum(~occupied_up.astype('bool')), 
-    #      absL, sum(~occupied_lo.astype('bool')))
-    #print('->', len(grid_lo), len(grid_lo[0]))
-    #print('->', len(grid_up), len(grid_up[0]))
-
-
-    ## OLD GRID
-        
+    grid_lo = np.zeros((lo_lipids_x, lo_lipids_y))
+    grid_up = np.zeros((up_lipids_x, up_lipids_y))
+
     maxd = 1
 
     # If there is a protein, mark the corresponding cells as occupied
@@ -395,56 +945,28 @@ def setup_membrane(pbc, protein, lipid, options):
 
         # Calculate number density per cell
         mem_mask_lo = (0 > protein.coord[:,2]) & (protein.coord[:,2] > -2.4)
-        prot_lo = protein.coord[mem_mask_lo, :]
-        for i in prot_lo:
-            for x, y, z in i + sphere:
-                grid_lo[ int(lo_lipids_x*x/pbc.rx)%lo_lipids_x ][ int(lo_lipids_y*y/pbc.ry)%lo_lipids_y ] += 1
+        grid_lo = footprint(grid_lo.shape, pbc, protein.coord[mem_mask_lo, :], sphere)
 
         mem_mask_up = (0 < protein.coord[:,2]) & (protein.coord[:,2] < 2.4)
-        prot_up = protein.coord[mem_mask_up, :]
-        for i in prot_up:
-            for x, y, z in i + sphere:
-                grid_up[ int(up_lipids_x*x/pbc.rx)%up_lipids_x ][ int(up_lipids_y*y/pbc.ry)%up_lipids_y ] += 1
+        grid_up = footprint(grid_up.shape, pbc, protein.coord[mem_mask_up, :], sphere)
 
         # Determine which cells to consider occupied, given the fudge factor
-        # The array is changed to boolean type here
-        maxd = float(max([max(i) for i in grid_up+grid_lo]))
+        maxd = float(max(grid_up.max(), grid_lo.max()))
         if  maxd == 0:
             print("; The protein seems not to be inside the membrane.", file=sys.stderr)
             print("; Run with -orient to put it in.", file=sys.stderr)
             maxd = 1
 
+    # The arrays are changed to boolean type here
     fudge   = options["fudge"]
-    grid_up = [[(j/maxd) <= fudge for j in i] for i in grid_up]
-    grid_lo = [[(j/maxd) <= fudge for j in i] for i in grid_lo]
+    grid_up = (grid_up/maxd) <= fudge
+    grid_lo = (grid_lo/maxd) <= fudge
 
     # If we don't want lipids inside of the protein
-    # we also mark everything from the center up to the first cell filled
+    # we also mark the cells enclosed by protein
     if not options["inside"]:
-
-        # Upper leaflet
-        marked = [(i, j) for i in up_rlipx for j in up_rlipy if not grid_up[i][j]]
-        if marked:
-            # Find the center
-            cx, cy  = [float(sum(i))/len(marked) for i in zip(*marked)]
-            for i, j in marked:
-                md = int(abs(i-cx)+abs(j-cy)) # Manhattan length/distance
-                for f in range(md):
-                    ii = int(cx+f*(i-cx)/md)
-                    jj = int(cy+f*(j-cy)/md)
-                    grid_up[ii][jj] = False
-
-        # Lower leaflet
-        marked = [(i, j) for i in lo_rlipx for j in lo_rlipy if not grid_lo[i][j]]
-        if marked:
-            # Find the center
-            cx, cy  = [float(sum(i))/len(marked) for i in zip(*marked)]
-            for i, j in marked:
-                md = int(abs(i-cx)+abs(j-cy)) # Manhattan length
-                for f in range(md):
-                    ii = int(cx+f*(i-cx)/md)
-                    jj = int(cy+f*(j-cy)/md)
-                    grid_lo[ii][jj] = False
+        grid_up &= ~enclosed(grid_up)
+        grid_lo &= ~enclosed(grid_lo)
 
     # If we make a circular patch, we flag the cells further from the
     # protein or box center than the given radius as occupied.
@@ -453,98 +975,50 @@ def setup_membrane(pbc, protein, lipid, options):
             cx, cy = protein.center[:2]
         else:
             cx, cy = 0.5*pbc.x, 0.5*pbc.y
-        for i in range(len(grid_lo)):
-            for j in range(len(grid_lo[i])):
-                if (i*pbc.x/lo_lipids_x - cx)**2 + (j*pbc.y/lo_lipids_y - cy)**2 > options["disc"]**2:
-                    grid_lo[i][j] = False
-        for i in range(len(grid_up)):
-            for j in range(len(grid_up[i])):
-                if (i*pbc.x/up_lipids_x - cx)**2 + (j*pbc.y/up_lipids_y - cy)**2 > options["disc"]**2:
-                    grid_up[i][j] = False
+        for grid in (grid_lo, grid_up):
+            nx, ny = grid.shape
+            cells = np.stack(np.meshgrid(np.arange(nx)*pbc.x/nx, np.arange(ny)*pbc.y/ny, 0,
+                                         indexing='ij')[:3], axis=-1)[:, :, 0]
+            grid &= pbc.distance(cells, (cx, cy, 0)) <= options["disc"]
 
     # If we need to add a hole, we simply flag the corresponding cells
     # as occupied. The position of the hole depends on the type of PBC,
     # to ensure an optimal arrangement of holes around the protein. If
-    # there is no protein, the hole is just put in the center.
+    # there is no protein, the hole is just put in the center. Holes can
+    # also be put at given positions, one for each center given.
+    # The distances are measured in grid cells, with the lattice of
+    # periodic images of the grid following the tilt of the box.
     if options["hole"]:
-        # Lower leaflet
-        if protein:
-            if ("square".startswith(options["pbc"]) or
-                "rectangular".startswith(options["pbc"])):
-                hx, hy = (0, 0)
-            else:
-                hx, hy = (0, int(lo_lipids_y*np.cos(np.pi/6)/9+0.5))
-        else:
-            hx, hy = (int(0.5*lo_lipids_x), int(0.5*lo_lipids_y))
-        hr = int(options["hole"]/min(lo_lipdx,  lo_lipdy)+0.5)
-        ys = int(lo_lipids_x*pbc.box[1,0]/pbc.box[0,0]+0.5)
-        print("; Making a hole with radius %f nm centered at grid cell (%d,%d)"%(options["hole"], hx, hy), hr, file=sys.stderr)
-        hr -= 1
-        for ii in range(hx-hr-1, hx+hr+1):
-            for jj in range(hx-hr-1, hx+hr+1):
-                xi, yj = ii, jj
-                if (ii-hx)**2+(jj-hy)**2 < hr**2:
-                    if jj < 0:
-                        xi += ys
-                        yj += lo_lipids_y
-                    if jj >= lo_lipids_y:
-                        xi -= ys
-                        yj -= lo_lipids_y
-                    if xi < 0:
-                        xi += lo_lipids_x
-                    if xi >= lo_lipids_x:
-                        xi -= lo_lipids_x
-                    grid_lo[xi][yj] = False
-                    grid_up[xi][yj] = False
-        # Upper leaflet
-        if protein:
-            if ("square".startswith(options["pbc"]) or
-                "rectangular".startswith(options["pbc"])):
-                hx, hy = (0, 0)
+        for grid, lipdx, lipdy in ((grid_lo, lo_lipdx, lo_lipdy), (grid_up, up_lipdx, up_lipdy)):
+            nx, ny = grid.shape
+            if options["holecenter"]:
+                centers = hole_cells(options["holecenter"], (nx, ny), pbc)
+            elif protein:
+                if ("square".startswith(options["pbc"]) or
+                    "rectangular".startswith(options["pbc"])):
+                    centers = [(0, 0)]
+                else:
+                    centers = [(0, int(ny*np.cos(np.pi/6)/9+0.5))]
             else:
-                hx, hy = (0, int(up_lipids_y*np.cos(np.pi/6)/9+0.5))
-        else:
-            hx, hy = (int(0.5*up_lipids_x), int(0.5*up_lipids_y))
-        hr = int(options["hole"]/min(up_lipdx, up_lipdy)+0.5)
-        ys = int(up_lipids_x*pbc.box[1,0]/pbc.box[0,0]+0.5)
-        print("; Making a hole with radius %f nm centered at grid cell (%d,%d)"%(options["hole"], hx, hy), hr, file=sys.stderr)
-        hr -= 1
-        for ii in range(hx-hr-1, hx+hr+1):
-            for jj in range(hx-hr-1, hx+hr+1):
-                xi, yj = ii, jj
-                if (ii-hx)**2+(jj-hy)**2 < hr**2:
-                    if jj < 0:
-                        xi += ys
-                        yj += up_lipids_y
-                    if jj >= up_lipids_y:
-                        xi -= ys
-                        yj -= up_lipids_y
-                    if xi < 0:
-                        xi += up_lipids_x
-                    if xi >= up_lipids_x:
-                        xi -= up_lipids_x
-                    grid_up[xi][yj] = False
+                centers = [(int(0.5*nx), int(0.5*ny))]
+            hr = int(options["hole"]/min(lipdx,  lipdy)+0.5)
+            ys = int(nx*pbc.box[1,0]/pbc.box[0,0]+0.5)
+            for hx, hy in centers:
+                print("; Making a hole with radius %f nm centered at grid cell (%d,%d)"%(options["hole"], hx, hy), hr, file=sys.stderr)
+            hr -= 1
+            grid &= hole_mask((nx, ny), ys, centers, hr)
 
     # Set the XY coordinates
-    # To randomize the lipids we add a random number which is used for sorting
-    upper, lower = [], []
-    for i in range(up_lipids_x):
-        for j in range(up_lipids_y):
-            if grid_up[i][j]:
-                upper.append((random.random(), i*pbc.x/up_lipids_x, j*pbc.y/up_lipids_y))
-    for i in range(lo_lipids_x):
-        for j in range(lo_lipids_y):
-            if grid_lo[i][j]:
-                lower.append((random.random(), i*pbc.x/lo_lipids_x, j*pbc.y/lo_lipids_y))
-
-    # Sort on the random number
-    upper.sort()
-    lower.sort()
+    # To randomize the lipids the positions are sorted on a random number
+    upper = np.argwhere(grid_up) * (pbc.x, pbc.y) / (up_lipids_x, up_lipids_y)
+    lower = np.argwhere(grid_lo) * (pbc.x, pbc.y) / (lo_lipids_x, lo_lipids_y)
+    upper = upper[np.argsort(random_generator(LATTICE_STREAM, 0).random(len(upper)), kind='stable')]
+    lower = lower[np.argsort(random_generator(LATTICE_STREAM, 1).random(len(lower)), kind='stable')]
 
     # Extract coordinates, taking asymmetry in account
     asym  = options["asymmetry"] or 0
-    upper = [i[1:] for i in upper[max(0, asym):]]
-    lower = [i[1:] for i in lower[max(0, -asym):]]
+    upper = [tuple(i) for i in upper[max(0, asym):].tolist()]
+    lower = [tuple(i) for i in lower[max(0, -asym):].tolist()]
 
     print("; X: %.3f (%d bins) Y: %.3f (%d bins) in upper leaflet"%(pbc.x, up_lipids_x, pbc.y, up_lipids_y), file=sys.stderr)
     print("; X: %.3f (%d bins) Y: %.3f (%d bins) in lower leaflet"%(pbc.x, lo_lipids_x, pbc.y, lo_lipids_y), file=sys.stderr)
@@ -568,13 +1042,6 @@ def setup_membrane(pbc, protein, lipid, options):
 
     ##> Building lipids
 
-    kick       = options["randkick"]
-
-    mematoms = []
-    memcoords = []
-
-    # Build the membrane
-
     ## ==> LIPID  BOOKKEEPING:
     # Read lipids defined in insane
     liplist = lipids.get_lipids()
@@ -593,50 +1060,21 @@ def setup_membrane(pbc, protein, lipid, options):
             CHARGES[key] = int(liplist[key].charge)
 
     if protein:
-        resi = protein.atoms[-1][2]
+        resi = int(protein.resids[-1])
     else:
         resi = 0
 
-    inshift = options["indist"] / 2
-    for leaflet, leaf_lip, lipd, lipdx, lipdy in [leaf_up, leaf_lo]:
-        for lipid, pos in leaf_lip:
-            # Increase the residue number by one
-            resi += 1
-
-            # Fetch the atom list with x, y, z coordinates
-            try:
-                at, ax, ay, az = zip(*liplist[lipid].build(diam=lipd))
-            except KeyError as e:
-                print(f"ERROR lipid name {e.args[0]} not found in database check lipids.dat, included mol files or specified definition strings")
-                raise e 
-            # The z-coordinates are spaced at 0.3 nm,
-            # starting with the first bead at 0.15 nm
-            az = [ leaflet*(inshift + (i-min(az)))*options["beaddist"] for i in az ]
-            xx = np.array((ax, ay)).T
-
-            # Set the random rotation for this lipid
-            rangle   = 2*random.random()*np.pi
-            if options["norotate"]:
-                nx = pos[0] + lipdx/2 + [ kick*random.random() for i in az ]
-                ny = pos[1] + lipdy/2 + [ kick*random.random() for i in az ]
-            else:
-                rcos     = np.cos(rangle)
-                rsin     = np.sin(rangle)
-                rcosx    = rcos*lipdx*2/3
-                rcosy    = rcos*lipdy*2/3
-                rsinx    = rsin*lipdx*2/3
-                rsiny    = rsin*lipdy*2/3
-                nx = np.dot(xx,(rcosx, -rsiny)) + pos[0] + lipdx/2 + [ kick*random.random() for i in az ]
-                ny = np.dot(xx,(rsinx, rcosy)) + pos[1] + lipdy/2 + [ kick*random.random() for i in az ]
-
-            # Add the atoms to the list
-            memcoords.extend([(nx[i], ny[i], az[i]) for i in range(len(at))])
-            mematoms.extend([(at[i], lipid, resi, 0, 0, 0) for i in range(len(at))])
+    leaflets = []
+    for index, (leaflet, leaf_lip, lipd, lipdx, lipdy) in enumerate([leaf_up, leaf_lo]):
+        lipnames, positions = list(zip(*leaf_lip)) or [(), ()]
+        rng = random_generator(LIPID_STREAM, index)
+        leaflets.append(build_leaflet(leaflet, lipnames, positions, lipd, lipdx, lipdy,
+                                      liplist, options, rng, resi))
+        resi += len(lipnames)
 
     ##< Done building lipids
 
-    membrane.coord = memcoords
-    membrane.atoms = mematoms
+    membrane = Structure.concatenate(leaflets)
 
     return membrane, molecules, liplist
 
@@ -723,19 +1161,13 @@ def old_main(**options):
         xshft = pbc.x/2
         prot.coord += (xshft, pbc.y/2, (not lipL)*pbc.z/2)
 
-    prot_coord = []
-    protein  = Structure()
-    for prot in tm:
-        # And we collect the atoms
-        protein.atoms.extend(prot.atoms)
-        prot_coord.append(prot.coord)
-    if tm:
-        protein.coord = np.concatenate(prot_coord)
+    # And we collect the atoms
+    protein  = Structure.concatenate(tm)
 
     # Current residue ID is set to that of the last atom
     resi = 0 
     if protein:
-        resi = protein.atoms[-1][2]
+        resi = int(protein.resids[-1])
 
     ## 2. Lipids
 
@@ -746,27 +1178,44 @@ def old_main(**options):
     if added:
         # Now move everything to the center of the box before adding solvent
         mz  = pbc.z/2
-        z   = (protein+membrane).coord[:,2]
-        mz -= (max(z)+min(z))/2
+        z   = [part.coord[:,2] for part in (protein, membrane) if len(part)]
+        mz -= (max(i.max() for i in z)+min(i.min() for i in z))/2
         protein.coord += (0, 0, mz)
         membrane.coord += (0, 0, mz)
 
     if membrane:
-        resi = membrane.atoms[-1][2]
+        resi = int(membrane.resids[-1])
 
     ################
     ## 3. SOLVENT ##
     ################
 
 
-    solvent, added = setup_solvent(pbc, protein, membrane, options)
+    # Protein and membrane are complete, and can be written while the
+    # solvent is being built
+    writer = None
+    if options["pipeline"] and StructureWriter.supports(options["output"]):
+        writer = StructureWriter(options["output"],
+                                 system_title(membrane, protein, lipid), pbc.box)
+        writer.write(StructureChain(protein, membrane))
+
+    try:
+        solvent, added = setup_solvent(pbc, protein, membrane, options)
+    except BaseException:
+        if writer:
+            writer.abort()
+        raise
     molecules.extend(added)
 
+    if writer:
+        writer.write(solvent)
+        writer.close()
+
     return (molecules, protein, membrane, solvent, lipid, pbc.box, liplist)
 
 
 def write_summary(protein, membrane, solvent):
-    charge  = protein.charge + membrane.charge
+    charge  = StructureChain(protein, membrane).charge
     plen = len(protein)
     print("; NDX Solute %d %d" % (1, protein and plen or 0), file=sys.stderr)
     print("; Charge of protein: %f" % protein.charge, file=sys.stderr)
@@ -870,7 +1319,7 @@ def write_top(outpath, molecules, title, liplist):
 
 def system_title(membrane, protein, lipids):
     (lipL, absL, relL), (lipU, absU, relU) = lipids
-    if membrane.atoms:
+    if len(membrane):
         title  = "INSANE! Membrane UpperLeaflet>"+":".join(lipU)+"="+":".join([str(i) for i in relU])
         title += " LowerLeaflet>"+":".join(lipL)+"="+":".join([str(i) for i in relL])
 
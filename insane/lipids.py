@@ -16,13 +16,16 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
+from collections import namedtuple
 from collections.abc import MutableMapping
 import math
 import os
 
+import numpy as np
+
 from . import utils
 
-__all__ = ['Lipid', 'Lipid_List', 'get_lipids']
+__all__ = ['Lipid', 'LipidTemplate', 'Lipid_List', 'get_lipids']
 
 
 # Lipid data file
@@ -47,6 +50,9 @@ LINKBEADS = {
     "O":  "OH",  # Amide (Ceramide/Sphingomyelin), in Martini 3 old AM1 is called OH1 
 }
 
+# Compiled lipid: bead names, (N, 2) array of x/y and (N,) array of z
+LipidTemplate = namedtuple('LipidTemplate', 'names xy z')
+
 
 class Lipid:
     """Lipid structure"""
@@ -64,6 +70,7 @@ class Lipid:
         self.area      = kwargs.get("area")
         self.diam      = kwargs.get("diam", math.sqrt(kwargs.get("area", 0)))
         self.coords    = None
+        self._templates = {}
         if "source" in kwargs:
             source = kwargs["source"]
             self.source = source
@@ -98,8 +105,8 @@ class Lipid:
         #    # Infer charge from head groups
         #    self.charge = sum([headgroup_charges[bead] for bead in self.head])
 
-    def build(self, **kwargs):
-        """Build/return a list of [(bead, x, y, z), ...]"""
+    def compile(self):
+        """Return the list of [bead, x, y, z] pseudo-coordinates, unscaled"""
 
         if not self.coords:
             if self.beads and self.template:
@@ -140,20 +147,37 @@ class Lipid:
                     for i, (x, y, z) in zip(beads, struc)
                 ]
 
-        # Scale the x/y based on the lipid's APL - diameter is less than sqrt(APL)
-        diam   = kwargs.get("diam", self.diam)
-        radius = diam*0.45
-        minmax = [ (min(i), max(i)) for i in list(zip(*self.coords))[1:] ]
-        mx, my, mz = [ sum(i)/2. for i in minmax ]
-        scale  = radius/math.sqrt((minmax[0][0]-mx)**2 + (minmax[1][0]-my)**2)
+        return self.coords
 
-        for i in self.coords:
-            i[1] = scale*(i[1]-mx)
-            i[2] = scale*(i[2]-my)
-            i[3] -= minmax[2][0]
+    def compiled(self, diam=None):
+        """
+        Return the template of the lipid for a given diameter.
 
-        return self.coords
+        The template holds the bead names, the x/y coordinates scaled to
+        the diameter, and the z coordinates in bead units, starting at 0.
+        Templates are compiled once per diameter and the arrays are
+        read-only, so they can be shared.
+        """
+        # Scale the x/y based on the lipid's APL - diameter is less than sqrt(APL)
+        diam = float(self.diam if diam is None else diam)
+        if diam not in self._templates:
+            names, x, y, z = zip(*self.compile())
+            coords = np.array((x, y, z), dtype=float).T
+            low, high = coords.min(axis=0), coords.max(axis=0)
+            mx, my, mz = (low + high) / 2.
+            radius = diam*0.45
+            scale  = radius/math.sqrt((low[0]-mx)**2 + (low[1]-my)**2)
+            xy = scale*(coords[:, :2] - (mx, my))
+            z  = coords[:, 2] - low[2]
+            xy.flags.writeable = False
+            z.flags.writeable = False
+            self._templates[diam] = LipidTemplate(names, xy, z)
+        return self._templates[diam]
 
+    def build(self, **kwargs):
+        """Build/return a list of [(bead, x, y, z), ...]"""
+        names, xy, z = self.compiled(kwargs.get("diam"))
+        return [[i, x, y, zi] for i, (x, y), zi in zip(names, xy.tolist(), z.tolist())]
 
     def h(self, head):
         self.head = head.replace(".", " ").split()
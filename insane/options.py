@@ -29,6 +29,8 @@ OPTIONS = Options([
         (0, "-o",   "output",    str,         1,        None,    MA, "Output GRO file: Membrane with Protein"),
         (0, "-p",   "topology",  str,         1,        None,     0, "Optional rudimentary topology file"),
         (0, "-dat", "lipids",    str,         1,        None, MULTI, "Optional additional lipids.dat files (can be given multiple times)"),
+        (1, "-stream", "stream", bool,        0,        None,     0, "Build the solvent slab by slab while writing the output, to limit memory use"),
+        (1, "-pipe",   "pipeline", bool,      0,        None,     0, "Write protein and membrane in the background while the solvent is being built (GRO or PDB output)"),
         """
     Periodic boundary conditions
     If -d is given, set up PBC according to -pbc such that no periodic
@@ -62,6 +64,7 @@ OPTIONS = Options([
         (1, "-au",   "uparea",    float,       1,        None,     0, "Area per lipid (nm*nm) for upper layer"),
         (1, "-asym", "asymmetry", int,         1,        None,     0, "Membrane asymmetry (number of lipids)"),
         (0, "-hole", "hole",      float,       1,           0,     0, "Make a hole in the membrane with specified radius"),
+        (1, "-hc",   "holecenter",vector,      1,        None, MULTI, "Center (x,y in nm) of a hole; can be given multiple times for several holes"),
         (0, "-disc", "disc",      float,       1,        None,     0, "Make a membrane disc with specified radius"),
         (2, "-rand", "randkick",  float,       1,         0.1,     0, "Random kick size (maximum atom displacement)"),
         (2, "-norot","norotate",  bool,        0,        None,     0, "Do not rotate lipids in plane"),
@@ -89,6 +92,8 @@ OPTIONS = Options([
         (1, "-sold",   "soldiam",     float,       1,         0.5,     0, "Solvent diameter"),
         (1, "-solr",   "solrandom",   float,       1,         0.1,     0, "Solvent random kick"),
         (2, "-excl",   "solexcl",     float,       1,         1.5,     0, "Exclusion range (nm) for solvent addition relative to membrane center"),
+        (1, "-nt",     "workers",     int,         1,           1,     0, "Number of processes for building the solvent and writing GRO output"),
+        (1, "-solbox", "solbox",      str,         1,        None,     0, "Pre-equilibrated solvent box (GRO/PDB) to tile over the unit cell instead of placing solvent on a grid"),
         """
     Salt related options.
     """,
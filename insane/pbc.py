@@ -1,4 +1,6 @@
 
+import itertools
+
 import numpy as np
 
 RTOL = 1e-8
@@ -174,3 +176,68 @@ class PBC(object):
         return self.box[2,2] + RTOL
 
 
+
+    def to_fractional(self, coord):
+        """
+        Return the coordinates (N, 3) in units of the box vectors.
+        """
+        return np.asarray(coord, dtype=float) @ np.linalg.inv(self.box)
+
+    def to_cartesian(self, fractional):
+        """
+        Return the cartesian coordinates (N, 3) for fractional coordinates.
+        """
+        return np.asarray(fractional, dtype=float) @ self.box
+
+    def wrap(self, coord):
+        """
+        Return the coordinates (N, 3) put in the rectangular brick spanned
+        by the diagonal of the box.
+
+        For a box with the vectors in lower triangular form, as used here,
+        the brick is a unit cell. The coordinates are shifted over the box
+        vectors, from z to x, keeping the tilt of the box into account.
+        """
+        coord = np.array(coord, dtype=float)
+        for dim in (2, 1, 0):
+            if self.box[dim, dim]:
+                shift = np.floor(coord[..., dim] / self.box[dim, dim])
+                coord = coord - shift[..., None] * self.box[dim]
+        return coord
+
+    def minimum_image(self, delta):
+        """
+        Return the shortest periodic images of difference vectors (N, 3).
+
+        The vectors are first reduced over the box vectors from z to x. In a
+        triclinic box that is not always the shortest image, so the
+        neighbouring images, shifted by -1, 0 or 1 times each box vector,
+        are checked as well.
+        """
+        delta = np.array(delta, dtype=float)
+        for dim in (2, 1, 0):
+            if self.box[dim, dim]:
+                shift = np.round(delta[..., dim] / self.box[dim, dim])
+                delta = delta - shift[..., None] * self.box[dim]
+        shortest = delta
+        best = (delta**2).sum(axis=-1)
+        vectors = [self.box[dim] if self.box[dim, dim] else np.zeros(3) for dim in range(3)]
+        for factors in itertools.product((-1, 0, 1), repeat=3):
+            if not any(factors):
+                continue
+            image = delta + np.dot(factors, vectors)
+            length = (image**2).sum(axis=-1)
+            closer = length < best
+            shortest = np.where(closer[..., None], image, shortest)
+            best = np.where(closer, length, best)
+        return shortest
+
+    def distance(self, a, b):
+        """
+        Return the minimum image distances between coordinates a and b.
+
+        The coordinates are arrays (N, 3), or anything that broadcasts
+        to the same shape, like a single point.
+        """
+        delta = self.minimum_image(np.asarray(a, dtype=float) - np.asarray(b, dtype=float))
+        return np.sqrt((delta**2).sum(axis=-1))
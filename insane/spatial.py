@@ -0,0 +1,155 @@
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Neighbour search with cell lists.
+
+The points are binned in cells at least as large as the cut-off, so that
+the neighbours of a query are found in the surrounding cells only. The
+search works in 2 or 3 dimensions, in open space or with periodic
+boundary conditions in a (triclinic) box.
+"""
+
+import itertools
+
+import numpy as np
+
+__all__ = ['CellList', 'count_within', 'any_within']
+
+
+class CellList(object):
+    """
+    Points binned in cells for finding the points within a cut-off.
+
+    Parameters
+    ----------
+    points
+        Array (N, D) with the coordinates of the points.
+    cutoff
+        The search radius.
+    box
+        Array (D, D) with the box vectors as rows, for periodic boundary
+        conditions, or None to search in open space. The cut-off should
+        not exceed the width of the box.
+    """
+    def __init__(self, points, cutoff, box=None):
+        self.points = np.asarray(points, dtype=float)
+        self.dim    = self.points.shape[1]
+        self.cutoff = float(cutoff)
+        self.box    = None if box is None else np.asarray(box, dtype=float)
+
+        if self.box is None:
+            # Cells of size cutoff over the bounding box of the points
+            self.origin = self.points.min(axis=0) if len(self.points) else np.zeros(self.dim)
+            extent = self.points.max(axis=0) - self.origin if len(self.points) else np.zeros(self.dim)
+            self.shape = np.maximum(1, (extent // self.cutoff).astype(int) + 1)
+        else:
+            # Cells in fractional coordinates, with a width of at least
+            # cutoff perpendicular to the faces of the box
+            self.inverse = np.linalg.inv(self.box)
+            width = 1 / np.sqrt((self.inverse**2).sum(axis=0))
+            self.shape = np.maximum(1, (width // self.cutoff).astype(int))
+            # Put the points in the unit cell
+            fractional = self.points @ self.inverse
+            fractional -= np.floor(fractional)
+            self.points = fractional @ self.box
+
+        cells = self._cells(self.points)
+        if self.box is not None:
+            cells = np.minimum(cells, self.shape - 1)
+        cells = self._flat(cells)
+        self.order  = np.argsort(cells, kind='stable')
+        self.bounds = np.searchsorted(cells[self.order], np.arange(self.shape.prod() + 1))
+
+    def _cells(self, points):
+        if self.box is None:
+            return ((points - self.origin) // self.cutoff).astype(int)
+        fractional = points @ self.inverse
+        return np.floor(fractional * self.shape).astype(int)
+
+    def _flat(self, cells):
+        return np.ravel_multi_index(cells.T, self.shape, mode='wrap')
+
+    def pairs(self, queries):
+        """
+        Return the indices of queries and points within the cut-off.
+
+        The indices are returned as two arrays, followed by an array with
+        the squared distances. With periodic boundary conditions, a point
+        can be paired more than once with a query, once for each image
+        within the cut-off.
+        """
+        queries = np.asarray(queries, dtype=float).reshape((-1, self.dim))
+        cells = self._cells(queries)
+        qidx, pidx, dist = [], [], []
+        for offset in itertools.product((-1, 0, 1), repeat=self.dim):
+            neighbour = cells + offset
+            if self.box is None:
+                valid = np.all((neighbour >= 0) & (neighbour < self.shape), axis=1)
+                images = np.zeros((len(queries), self.dim))
+            else:
+                valid = np.ones(len(queries), dtype=bool)
+                images = (neighbour // self.shape) @ self.box
+            flat = self._flat(neighbour[valid])
+            start, stop = self.bounds[flat], self.bounds[flat + 1]
+            sizes = stop - start
+            if not sizes.sum():
+                continue
+            which = np.repeat(np.nonzero(valid)[0], sizes)
+            offsets = np.repeat(np.cumsum(sizes) - sizes, sizes)
+            members = self.order[np.repeat(start, sizes) + np.arange(sizes.sum()) - offsets]
+            delta = queries[which] - (self.points[members] + images[which])
+            d2 = (delta**2).sum(axis=1)
+            close = d2 < self.cutoff**2
+            qidx.append(which[close])
+            pidx.append(members[close])
+            dist.append(d2[close])
+        if not qidx:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+        return np.concatenate(qidx), np.concatenate(pidx), np.concatenate(dist)
+
+    def count(self, queries, chunk=100000):
+        """
+        Return the number of points within the cut-off of each query.
+        """
+        queries = np.asarray(queries, dtype=float).reshape((-1, self.dim))
+        counts = np.zeros(len(queries), dtype=int)
+        for start in range(0, len(queries), chunk):
+            which, _, _ = self.pairs(queries[start:start+chunk])
+            counts[start:start+chunk] = np.bincount(which, minlength=len(queries[start:start+chunk]))
+        return counts
+
+    def any(self, queries, chunk=100000):
+        """
+        Return whether there is any point within the cut-off of each query.
+        """
+        return self.count(queries, chunk) > 0
+
+
+def count_within(queries, points, radius, box=None):
+    """
+    Return the number of points within radius of each query.
+    """
+    return CellList(points, radius, box).count(queries)
+
+
+def any_within(queries, points, radius, box=None):
+    """
+    Return whether there is any point within radius of each query.
+    """
+    return CellList(points, radius, box).any(queries)
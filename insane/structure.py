@@ -1,18 +1,22 @@
 
+import os
+import sys
+import bz2
+import gzip
+import lzma
+import mmap
+import queue
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 
 from .converters import *
+from .spatial import count_within
 from ._data import SOLVENTS, CHARGES, APOLARS
 
 
-def occupancy(grid, points, spacing=0.01):
-    """Return a vector with the occupancy of each grid point for 
-    given array of points"""
-    distances = ((grid[:,None,:] - points[None,:,:])**2).sum(axis=2)
-    occupied = (distances < spacing).sum(axis=1)
-    return occupied
-
-
 def isPDBAtom(l):
     return l.startswith("ATOM") or l.startswith("HETATM")
 
@@ -64,22 +68,193 @@ def groBoxRead(a):
     return b[0], b[3], b[4], b[5], b[1], b[6], b[7], b[8], b[2]
 
 
+def groBoxString(box):
+    grobox = (box[0][0], box[1][1], box[2][2],
+              box[0][1], box[0][2], box[1][0],
+              box[1][2], box[2][0], box[2][1])
+    return ('{:10.5f}' * 9).format(*grobox)
+
+
+def read_buffer(filename):
+    """
+    Return the contents of a file as a buffer of bytes.
+
+    Gzip compressed files are decompressed in memory, other files are
+    memory mapped.
+    """
+    with open(filename, 'rb') as infile:
+        if infile.read(2) == b'\x1f\x8b':
+            infile.seek(0)
+            with gzip.GzipFile(fileobj=infile) as unzipped:
+                return unzipped.read()
+        try:
+            return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files can not be mapped
+            return b''
+
+
+def line_bounds(chars):
+    """
+    Return the offsets of the starts and the ends of the lines in an
+    array of characters. The ends point to the newlines.
+    """
+    newlines = np.flatnonzero(chars == ord('\n'))
+    starts = np.concatenate(([0], newlines + 1))
+    ends = np.append(newlines, len(chars))
+    if starts[-1] == len(chars):
+        # Nothing after the last newline
+        starts, ends = starts[:-1], ends[:-1]
+    return starts, ends
+
+
+def fixed_width(chars, starts, ends, first, last):
+    """
+    Return the fixed width field [first:last] of the lines with the
+    given bounds, as an array of bytes. Lines too short for the field
+    are padded with spaces.
+    """
+    index = starts[:, None] + np.arange(first, last)
+    inside = index < ends[:, None]
+    field = np.where(inside, chars[np.minimum(index, len(chars) - 1)], ord(' '))
+    return field.astype(np.uint8).view('S{}'.format(last - first)).ravel()
+
+
+def categorical(field):
+    """
+    Return a Categorical column for a field of bytes.
+    """
+    table, codes = np.unique(field, return_inverse=True)
+    return Categorical(codes=codes, table=[value.decode() for value in table])
+
+
+def strip_forcefield(resname):
+    # Remove any -ff tags from molecules - WARNING no name can contain . as used as separator
+    return resname.split('.')[1] if '.' in resname else resname
+
+
+class Categorical(object):
+    """
+    Column of strings, stored as integer codes into a table of unique strings.
+
+    Atom and residue names take few distinct values over many atoms. Stored
+    this way, they take a few bytes per atom, and operations on the names
+    (like stripping them) only need to be done once per distinct value.
+    """
+    def __init__(self, values=(), codes=None, table=None):
+        if codes is None:
+            table, codes = np.unique(np.array(list(values), dtype=object),
+                                     return_inverse=True)
+        self.table = np.array(list(table) + [None], dtype=object)[:-1]
+        self.codes = np.asarray(codes, dtype=np.int32).ravel()
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        return iter(self.table[self.codes])
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self.table[self.codes[item]]
+        return self.__class__(codes=self.codes[item], table=self.table)
+
+    def __eq__(self, value):
+        return self.isin([value])
+
+    def __ne__(self, value):
+        return ~self.isin([value])
+
+    def isin(self, values):
+        """
+        Return a boolean array telling which entries are in *values*.
+        """
+        values = set(values)
+        hits = [i for i, value in enumerate(self.table) if value in values]
+        return np.isin(self.codes, hits)
+
+    def map(self, function):
+        """
+        Return a new column with *function* applied to each distinct value.
+        """
+        table = [function(value) for value in self.table]
+        return self.__class__(codes=self.codes, table=table)
+
+    def tolist(self):
+        return self.table[self.codes].tolist()
+
+    @classmethod
+    def concatenate(cls, columns):
+        """
+        Return a single column with the entries of all columns, in order.
+        """
+        index = {}
+        for column in columns:
+            for value in column.table:
+                index.setdefault(value, len(index))
+        codes = [np.array([index[value] for value in column.table] + [0],
+                          dtype=np.int32)[column.codes]
+                 for column in columns]
+        return cls(codes=np.concatenate([np.zeros(0, dtype=np.int32)] + codes),
+                   table=list(index))
+
+
 class Structure(object):
+    """
+    Atoms and coordinates, stored by column.
+
+    The atom names, residue names and chains are Categorical columns, the
+    residue numbers an integer array, and the coordinates an (N, 3) array.
+    The atoms can still be accessed as a list of tuples
+    (name, resname, resid, chain, x, y, z) through the ``atoms`` attribute,
+    but this builds the tuples on each access.
+    """
     def __init__(self, filename=None, options=None):
         self.title   = ""
-        self.atoms   = []
-        self._coord  = None
+        self.names    = Categorical()
+        self.resnames = Categorical()
+        self.resids   = np.zeros(0, dtype=int)
+        self.chains   = Categorical()
+        self._coord  = np.zeros((0, 3))
         self.rest    = []
         self.box     = []
+        self.molecules = []
         self._center = None
 
         if filename:
-            lines = open(filename).readlines()
+            self.read(filename)
+
+        if options:
+            self.setup(**options)
+
+    def read(self, filename):
+        """
+        Read the atoms from a PDB or GRO file, which may be gzip compressed,
+        or from a binary snapshot written by write_npz.
+
+        The fixed width columns are parsed for all atoms at once.
+        """
+        if filename.endswith('.npz'):
+            self.read_npz(filename)
+            return
+        data = read_buffer(filename)
+        chars = np.frombuffer(data, dtype=np.uint8)
+        try:
+            starts, ends = line_bounds(chars)
+            record = fixed_width(chars, starts, ends, 0, 6)
+            atoms = np.char.startswith(record, b'ATOM') | (record == b'HETATM')
             # Try extracting PDB atom/hetatm definitions
-            self.rest   = []
-            self.atoms  = [pdbAtom(i) for i in lines if isPDBAtom(i) or self.rest.append(i)]
-            if self.atoms:
+            if atoms.any():
                 # This must be a PDB file
+                bounds = starts[atoms], ends[atoms]
+                self.names    = categorical(fixed_width(chars, *bounds, 12, 16))
+                self.resnames = categorical(fixed_width(chars, *bounds, 17, 20))
+                self.resids   = read_hybrid36(fixed_width(chars, *bounds, 22, 26))
+                self.chains   = categorical(fixed_width(chars, *bounds, 21, 22))
+                self.coord    = np.stack([fixed_width(chars, *bounds, i, i+8).astype(float)/10
+                                          for i in (30, 38, 46)], axis=1)
+                self.rest     = [bytes(data[i:j+1]).decode()
+                                 for i, j in zip(starts[~atoms], ends[~atoms])]
                 self.title = "THIS IS INSANE!\n"
                 for i in self.rest:
                     if i.startswith("TITLE"):
@@ -90,20 +265,102 @@ class Structure(object):
                         self.box = pdbBoxRead(i)
             else:
                 # This should be a GRO file
-                self.atoms = [groAtom(i) for i in lines[2:-1]]
-                self.rest  = [lines[0], lines[1], lines[-1]]
+                lines = [bytes(data[i:j+1]).decode() for i, j in
+                         zip(starts[[0, 1, -1]], ends[[0, 1, -1]])]
+                bounds = starts[2:-1], ends[2:-1]
+                self.names    = categorical(fixed_width(chars, *bounds, 10, 15))
+                self.resnames = categorical(fixed_width(chars, *bounds, 5, 10))
+                self.resids   = fixed_width(chars, *bounds, 0, 5).astype(int)
+                self.chains   = Categorical(codes=np.zeros(len(self.resids)), table=[" "])
+                self.coord    = np.stack([fixed_width(chars, *bounds, i, i+8).astype(float)
+                                          for i in (20, 28, 36)], axis=1)
+                self.rest  = lines
                 self.box   = groBoxRead(lines[-1])
                 self.title = lines[0]
+        finally:
+            # Release the memory map
+            del chars
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def read_npz(self, filename):
+        """
+        Read a binary snapshot written by write_npz, including the box and
+        the list of molecules.
+        """
+        with np.load(filename, allow_pickle=False) as snapshot:
+            self.names    = Categorical(codes=snapshot['names'], table=snapshot['name_table'].tolist())
+            self.resnames = Categorical(codes=snapshot['resnames'], table=snapshot['resname_table'].tolist())
+            self.chains   = Categorical(codes=snapshot['chains'], table=snapshot['chain_table'].tolist())
+            self.resids   = snapshot['resids'].astype(int)
+            self.coord    = snapshot['coord']
+            self.box      = tuple(snapshot['box'].ravel().tolist())
+            self.title    = str(snapshot['title'])
+            self.molecules = list(zip(snapshot['molecule_names'].tolist(),
+                                      snapshot['molecule_counts'].tolist()))
+        self.rest = []
+
+    @classmethod
+    def from_columns(cls, names, resnames, resids, coord, chains=None):
+        """
+        Return a Structure with the given columns.
+
+        The names and residue names can be Categorical columns or sequences
+        of strings.
+        """
+        result = cls()
+        result.names    = names if isinstance(names, Categorical) else Categorical(names)
+        result.resnames = resnames if isinstance(resnames, Categorical) else Categorical(resnames)
+        result.resids   = np.asarray(resids, dtype=int).ravel()
+        if chains is None:
+            chains = Categorical(codes=np.zeros(len(result.resids)), table=[" "])
+        result.chains   = chains if isinstance(chains, Categorical) else Categorical(chains)
+        result.coord    = coord
+        return result
+
+    @classmethod
+    def concatenate(cls, structures):
+        """
+        Return a single Structure with the atoms of all structures, in order.
+        """
+        structures = list(structures)
+        result = cls()
+        result.names    = Categorical.concatenate([s.names for s in structures])
+        result.resnames = Categorical.concatenate([s.resnames for s in structures])
+        result.resids   = np.concatenate([result.resids] + [s.resids for s in structures])
+        result.chains   = Categorical.concatenate([s.chains for s in structures])
+        result.coord    = np.concatenate([result.coord] + [s.coord for s in structures])
+        return result
 
-        if options:
-            self.setup(**options)
-
+    @property
+    def atoms(self):
+        return list(zip(self.names, self.resnames, self.resids.tolist(),
+                        self.chains, *self.coord.T.tolist()))
+
+    @atoms.setter
+    def atoms(self, atoms):
+        names, resnames, resids, chains, x, y, z = [list(column) for column in
+                                                    zip(*atoms)] or [[]]*7
+        self.names    = Categorical(names)
+        self.resnames = Categorical(resnames)
+        self.resids   = np.array(resids, dtype=int)
+        self.chains   = Categorical(chains)
+        self.coord    = list(zip(x, y, z))
 
     def __nonzero__(self):
-        return bool(self.atoms)
+        return bool(len(self))
 
     def __len__(self):
-        return len(self.atoms)
+        return len(self.resids)
+
+    def __getitem__(self, item):
+        """
+        Return the atoms selected by a slice, index array or mask as a
+        new Structure.
+        """
+        return self.from_columns(self.names[item], self.resnames[item],
+                                 self.resids[item], self.coord[item],
+                                 self.chains[item])
 
     def __iadd__(self, s):
         if self.coord.shape[0]:
@@ -111,45 +368,57 @@ class Structure(object):
         return self
 
     def __add__(self, other):
-        if hasattr(other, 'atoms') and hasattr(other, 'coord'):
-            result = self.__class__()
-            result.atoms.extend(self.atoms)
-            result.atoms.extend(other.atoms)
-            result.coord = np.concatenate((
-                self.coord.reshape((-1,3)),
-                other.coord.reshape((-1,3)))) ###
-            return result
+        if isinstance(other, Structure):
+            return self.concatenate((self, other))
         raise TypeError('Cannot add {} to {}'
                         .format(self.__class__, other.__class__))
 
     def __iter__(self):
-        atom_enumeration = enumerate(zip(self.atoms, self.coord), start=1)
-        for idx, (atom, (x, y, z)) in atom_enumeration:
-            atname, resname, resid = atom[:3]
-            if '.' in resname:
-                # Remove any -ff tags from molecules - WARNING no name can contain . as used as separator
-                resname = resname.split('.')[1]
+        resnames = self.resnames.map(strip_forcefield)
+        columns = zip(self.names, resnames, self.resids.tolist(), self.coord.tolist())
+        for idx, (atname, resname, resid, (x, y, z)) in enumerate(columns, start=1):
             yield idx, atname, resname, resid, x, y, z
 
     @property
     def coord(self):
-        if self._coord is None:
-            self._coord = np.array([i[4:7] for i in self.atoms]).reshape((-1,3))
         return self._coord
 
     @coord.setter
     def coord(self, other):
-        self._coord = np.array(other).reshape((-1,3))
+        self._coord = np.array(other, dtype=float).reshape((-1,3))
+
+    def __setattr__(self, name, value):
+        # The residue index and residue counts depend on the atom columns
+        if name in ("names", "resnames", "resids"):
+            self.__dict__["_residues"] = None
+            self.__dict__["_rescount"] = None
+        object.__setattr__(self, name, value)
+
+    @property
+    def residues(self):
+        """
+        Array with the index of the first atom of each residue.
+
+        A residue starts where the residue name or number changes.
+        """
+        if self._residues is None:
+            change = ((self.resids[1:] != self.resids[:-1]) |
+                      (self.resnames.codes[1:] != self.resnames.codes[:-1]))
+            starts = np.concatenate(([0], np.nonzero(change)[0] + 1))
+            self._residues = starts[:len(self)]
+        return self._residues
 
     @property
     def charge(self):
-        last = None
-        charge = 0
-        for j in self.atoms:
-            if not j[0].strip().startswith('v') and j[1:3] != last:
-                charge += CHARGES.get(j[1].strip(), 0)
-            last = j[1:3]
-        return charge
+        # Residues starting with a virtual site do not count
+        if self._rescount is None:
+            starts = self.residues
+            virtual = np.array([name.strip().startswith('v') for name in self.names.table], dtype=bool)
+            real = ~virtual[self.names.codes[starts]]
+            resnames = self.resnames.map(str.strip)
+            codes, counts = np.unique(resnames.codes[starts[real]], return_counts=True)
+            self._rescount = list(zip(resnames.table[codes], counts.tolist()))
+        return sum(CHARGES.get(resname, 0)*count for resname, count in self._rescount)
 
     @property
     def center(self):
@@ -189,7 +458,7 @@ class Structure(object):
                         bbmin[1]:bbmax[1]:(cells[1]*1j)].reshape((2,-1)).T
         # Occupied cells is approximately equal to grid points within
         # gridspacing distance of points
-        occupied = occupancy(grid, points, spacing)
+        occupied = count_within(grid, points, math.sqrt(spacing))
         # The occupied area follows from the fraction of occupied
         # cells times the area spanned by the bounding box
         return size[0]*size[1]*sum(occupied > 0)/occupied.size
@@ -211,8 +480,8 @@ class Structure(object):
         atom = np.zeros(n+2)
         phobic = np.zeros(n+2)
         binned = (n * (self.coord - m) / r).astype('int')
-        notdummy = np.array([ i[1] != "DUM" for i in self.atoms ])
-        apolar = np.array([ i[1].strip() in APOLARS for i in self.atoms ])
+        notdummy = self.resnames != "DUM"
+        apolar = self.resnames.map(str.strip).isin(APOLARS)
         for i,j,k in binned[notdummy]:
             atom[i,j,k] += 1
         for i,j,k in binned[apolar]:
@@ -328,7 +597,169 @@ class Structure(object):
         # at z = 0. The x/y need to be set still
 
 
-def write_gro(outfile, title, atoms, box):
+class StructureChain(object):
+    """
+    Several structures, iterated over as a single one.
+
+    The parts are not copied; they can be Structure instances or anything
+    else with a length that yields atoms the same way, like solvent that is
+    built while it is being written. The atoms are numbered continuously
+    over the parts.
+
+    Where a single array of coordinates is needed, it is built once, on
+    first access of coord, and shared afterwards. The parts should not be
+    changed after that.
+    """
+    def __init__(self, *parts):
+        self.parts  = parts
+        self._coord = None
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def __bool__(self):
+        return any(len(part) for part in self.parts)
+
+    __nonzero__ = __bool__
+
+    @property
+    def charge(self):
+        return sum(part.charge for part in self.parts)
+
+    @property
+    def coord(self):
+        if self._coord is None:
+            coord = [block.coord for block in structure_blocks(self)]
+            self._coord = np.concatenate(coord) if coord else np.zeros((0, 3))
+            self._coord.flags.writeable = False
+        return self._coord
+
+    def blocks(self):
+        """
+        Generate the parts as Structure instances, in order.
+        """
+        return structure_blocks(self)
+
+    def __iter__(self):
+        offset = 0
+        for part in self.parts:
+            for atom in part:
+                yield (offset + atom[0],) + atom[1:]
+            offset += len(part)
+
+
+def structure_blocks(atoms):
+    """
+    Generate the atoms of a Structure, StructureChain or solvent lattice
+    as Structure instances, in order.
+    """
+    if isinstance(atoms, Structure):
+        yield atoms
+    elif hasattr(atoms, 'parts'):
+        for part in atoms.parts:
+            yield from structure_blocks(part)
+    elif hasattr(atoms, 'blocks'):
+        yield from atoms.blocks()
+    else:
+        block = Structure()
+        block.atoms = [(atname, resname, resid, ' ', x, y, z)
+                       for _, atname, resname, resid, x, y, z in atoms]
+        yield block
+
+
+def format_integers(values, width, fill=' '):
+    """
+    Return non-negative integers as an array (N, width) of characters,
+    right aligned and padded with *fill*.
+    """
+    rest = np.array(values, dtype=np.int64)
+    chars = np.full((len(rest), width), ord(fill), dtype=np.uint8)
+    for column in range(width - 1, -1, -1):
+        show = rest > 0 if column < width - 1 else slice(None)
+        chars[show, column] = ord('0') + rest[show] % 10
+        rest //= 10
+    return chars
+
+
+def format_decimals(values, width, decimals):
+    """
+    Return numbers as an array (N, width) of characters, formatted like
+    '{:{width}.{decimals}f}'. Returns None if a number does not fit.
+    """
+    values = np.asarray(values, dtype=float)
+    scale = 10**decimals
+    with np.errstate(invalid='ignore'):
+        scaled = values * scale
+        rounded = np.rint(scaled)
+        # Numbers close to halfway, or too large, are rounded like python does
+        ambiguous = ~(np.abs(scaled) < 1e12) | (np.abs(np.abs(scaled - rounded) - 0.5) < 1e-6)
+    magnitude = np.where(ambiguous, 0, np.abs(rounded)).astype(np.int64)
+    negative = np.signbit(values)
+    left = width - decimals - 1
+    whole = magnitude // scale
+    if np.any(whole >= 10**(left - negative)):
+        return None
+    chars = np.empty((len(values), width), dtype=np.uint8)
+    chars[:, :left] = format_integers(whole, left)
+    chars[:, left] = ord('.')
+    chars[:, left+1:] = format_integers(magnitude % scale, decimals, fill='0')
+    # The minus sign goes right before the first digit
+    digits = (chars[:, :left] != ord(' ')).sum(axis=1)
+    rows = np.flatnonzero(negative)
+    chars[rows, left - digits[rows] - 1] = ord('-')
+    for row in np.flatnonzero(ambiguous):
+        text = '{:{}.{}f}'.format(values[row], width, decimals)
+        if len(text) != width:
+            return None
+        chars[row] = np.frombuffer(text.encode(), dtype=np.uint8)
+    return chars
+
+
+def format_names(column, template, width):
+    """
+    Return a Categorical column formatted with *template* as an array
+    (N, width) of characters. Returns None if a name does not fit.
+    """
+    table = [template.format(value).encode() for value in column.table]
+    if any(len(value) != width for value in table):
+        return None
+    table = np.frombuffer(b''.join(table), dtype=np.uint8).reshape((-1, width))
+    return table[column.codes]
+
+
+GRO_LINE_WIDTH = 45
+
+
+def gro_lines(block, first):
+    """
+    Return the atom lines of a GRO file for a Structure, numbering the
+    atoms from *first* on.
+    """
+    resnames = block.resnames.map(strip_forcefield)
+    index = np.arange(first, first + len(block)) % 100000
+    columns = [
+        format_integers(block.resids % 100000, 5),
+        format_names(resnames, '{:<5s}', 5),
+        format_names(block.names, '{:>5s}', 5),
+        format_integers(index, 5),
+        format_decimals(block.coord[:, 0], 8, 3),
+        format_decimals(block.coord[:, 1], 8, 3),
+        format_decimals(block.coord[:, 2], 8, 3),
+        np.full((len(block), 1), ord('\n'), dtype=np.uint8),
+    ]
+    if any(column is None for column in columns):
+        # Some field overflows its width; format atom by atom
+        atom_template = "{:5d}{:<5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}\n"
+        return ''.join(
+            atom_template.format(int(resid % 1e5), resname, atname, int(idx % 1e5), x, y, z)
+            for idx, atname, resname, resid, x, y, z in zip(
+                range(first, first + len(block)), block.names, resnames,
+                block.resids.tolist(), *block.coord.T.tolist())
+        )
+    return np.concatenate(columns, axis=1).tobytes().decode()
+
+
+def write_gro(outfile, title, atoms, box, chunk=100000):
     """
     Write a GRO file.
 
@@ -339,9 +770,12 @@ def write_gro(outfile, title, atoms, box):
     title
         The title of the GRO file. Must be a single line.
     atoms
-        An instance of Structure containing the atoms to write.
+        An instance of Structure (or StructureChain) containing the atoms
+        to write.
     box
         The periodic box as a 3x3 matrix.
+    chunk
+        The number of atoms formatted and written at once.
     """
     # Print the title
     print(title, file=outfile)
@@ -350,22 +784,202 @@ def write_gro(outfile, title, atoms, box):
     print("{:5d}".format(len(atoms)), file=outfile)
 
     # Print the atoms
-    atom_template = "{:5d}{:<5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}"
-    for idx, atname, resname, resid, x, y, z in atoms:
-        print(atom_template
-              .format(int(resid % 1e5), resname, atname, int(idx % 1e5),
-                      x, y, z),
-              file=outfile)
+    first = 1
+    for block in structure_blocks(atoms):
+        for start in range(0, len(block), chunk):
+            part = block[start:start+chunk] if len(block) > chunk else block
+            outfile.write(gro_lines(part, first))
+            first += len(part)
 
     # Print the box
-    grobox = (box[0][0], box[1][1], box[2][2],
-              box[0][1], box[0][2], box[1][0],
-              box[1][2], box[2][0], box[2][1])
-    box_template = '{:10.5f}' * 9
-    print(box_template.format(*grobox), file=outfile)
+    print(groBoxString(box), file=outfile)
+
+
+def write_gro_range(filename, offset, block, first):
+    """
+    Format the atom lines for a Structure into an existing GRO file, at the
+    given byte offset. Returns False, and leaves the file alone, if the
+    lines are not of the standard width.
+    """
+    lines = gro_lines(block, first).encode()
+    if len(lines) != GRO_LINE_WIDTH * len(block):
+        return False
+    with open(filename, 'r+b') as outfile:
+        # Memory maps start at a multiple of the allocation granularity
+        start = offset - offset % mmap.ALLOCATIONGRANULARITY
+        with mmap.mmap(outfile.fileno(), offset - start + len(lines), offset=start) as buffer:
+            buffer[offset - start:] = lines
+    return True
+
+
+class ProcessPool(ProcessPoolExecutor):
+    """
+    Process pool that keeps its number of workers, to bound the number of
+    jobs queued ahead.
+    """
+
+    def __init__(self, workers):
+        super().__init__(workers)
+        self.workers = workers
+
+
+_POOL = None
 
 
-def write_pdb(outfile, title, atoms, box):
+def process_pool(workers):
+    """
+    Return the process pool shared by the parallel builders and writers,
+    or None for a single worker.
+
+    The pool is started on first use and kept, so that the worker processes
+    are forked once per run rather than for every parallel step. It is only
+    replaced if another number of workers is asked for.
+    """
+    global _POOL
+    if workers < 2:
+        return None
+    if _POOL is None or _POOL.workers != workers:
+        if _POOL is not None:
+            _POOL.shutdown()
+        _POOL = ProcessPool(workers)
+    return _POOL
+
+
+def write_gro_parallel(filename, title, atoms, box, pool, chunk=100000):
+    """
+    Write a GRO file with a process pool, each process formatting a range
+    of atoms directly into its place in the file.
+
+    The file is allocated up front, as the atom lines are of fixed width.
+    Returns False if some line turns out to be wider, like for coordinates
+    beyond 9999.999 nm, in which case the file is incomplete and should be
+    written with write_gro instead.
+    """
+    # The workers of a shared pool may have been started in another directory
+    filename = os.path.abspath(filename)
+    header = '{}\n{:5d}\n'.format(title, len(atoms)).encode()
+    footer = (groBoxString(box) + '\n').encode()
+    size = len(header) + GRO_LINE_WIDTH * len(atoms) + len(footer)
+    with open(filename, 'wb') as outfile:
+        outfile.write(header)
+        outfile.truncate(size)
+        outfile.seek(size - len(footer))
+        outfile.write(footer)
+
+    fits = True
+    first = 1
+    pending = collections.deque()
+    for block in structure_blocks(atoms):
+        for start in range(0, len(block), chunk):
+            part = block[start:start+chunk] if len(block) > chunk else block
+            offset = len(header) + GRO_LINE_WIDTH * (first - 1)
+            pending.append(pool.submit(write_gro_range, filename, offset, part, first))
+            first += len(part)
+            if len(pending) > 2*pool.workers:
+                fits &= pending.popleft().result()
+    while pending:
+        fits &= pending.popleft().result()
+    return fits
+
+
+HYBRID36_DIGITS = (b'0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ',
+                   b'0123456789abcdefghijklmnopqrstuvwxyz')
+
+
+def hybrid36(values, width):
+    """
+    Return integers in hybrid-36 notation as an array (N, width) of
+    characters.
+
+    Numbers that fit the width, including negative ones, are written in
+    decimal. Larger numbers are written in base 36 with upper case
+    letters, starting at A000..., and then with lower case letters,
+    starting at a000.... Numbers beyond that range wrap around, and so do
+    negative numbers that do not fit.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    decimal = 10**width
+    block = 26 * 36**(width - 1)
+    values = np.where(values <= -10**(width - 1), values % decimal, values)
+    values = np.where(values >= decimal + 2*block, values % (decimal + 2*block), values)
+    chars = format_integers(np.where(values < decimal, np.abs(values), 0), width)
+    # The minus sign goes right before the first digit
+    rows = np.flatnonzero(values < 0)
+    digits = (chars[rows] != ord(' ')).sum(axis=1)
+    chars[rows, width - digits - 1] = ord('-')
+    for lower, digits in enumerate(HYBRID36_DIGITS):
+        rows = np.flatnonzero((values >= decimal + lower*block) &
+                              (values < decimal + (lower+1)*block))
+        rest = values[rows] - decimal - lower*block + 10 * 36**(width - 1)
+        digits = np.frombuffer(digits, dtype=np.uint8)
+        for column in range(width - 1, -1, -1):
+            chars[rows, column] = digits[rest % 36]
+            rest //= 36
+    return chars
+
+
+def read_hybrid36(field):
+    """
+    Return the integers for a fixed width field of bytes, with the numbers
+    in decimal or in hybrid-36 notation.
+    """
+    width = field.dtype.itemsize
+    chars = np.asarray(field).view(np.uint8).reshape((-1, width))
+    values = np.zeros(len(chars), dtype=int)
+    letters = np.frombuffer(b''.join(digits[10:] for digits in HYBRID36_DIGITS), dtype=np.uint8)
+    decimal = ~np.isin(chars[:, 0], letters)
+    values[decimal] = field[decimal].astype(int)
+    block = 26 * 36**(width - 1)
+    for lower, digits in enumerate(HYBRID36_DIGITS):
+        table = np.zeros(256, dtype=int)
+        table[np.frombuffer(digits, dtype=np.uint8)] = np.arange(36)
+        rows = np.flatnonzero(np.isin(chars[:, 0], np.frombuffer(digits[10:], dtype=np.uint8)))
+        number = np.zeros(len(rows), dtype=int)
+        for column in range(width):
+            number = 36*number + table[chars[rows, column]]
+        values[rows] = number - 10 * 36**(width - 1) + 10**width + lower*block
+    return values
+
+
+def pdb_lines(block, first):
+    """
+    Return the ATOM lines of a PDB file for a Structure, numbering the
+    atoms from *first* on. Atom and residue numbers that do not fit in
+    decimal are written in hybrid-36.
+    """
+    resnames = block.resnames.map(strip_forcefield)
+    serials = hybrid36(np.arange(first, first + len(block)), 5)
+    resids = hybrid36(block.resids, 4)
+    coord = 10 * block.coord
+    columns = [
+        np.frombuffer(b'ATOM  ', dtype=np.uint8)[None].repeat(len(block), axis=0),
+        serials,
+        np.full((len(block), 1), ord(' '), dtype=np.uint8),
+        format_names(block.names, '{:<4.4s}', 4),
+        np.full((len(block), 1), ord(' '), dtype=np.uint8),
+        format_names(resnames, '{:>4.3s}', 4),
+        np.full((len(block), 1), ord(' '), dtype=np.uint8),
+        resids,
+        np.full((len(block), 4), ord(' '), dtype=np.uint8),
+        format_decimals(coord[:, 0], 8, 3),
+        format_decimals(coord[:, 1], 8, 3),
+        format_decimals(coord[:, 2], 8, 3),
+        np.frombuffer(b'  0.00  0.00' + b' '*14 + b'\n', dtype=np.uint8)[None].repeat(len(block), axis=0),
+    ]
+    if any(column is None for column in columns):
+        # Some field overflows its width; format atom by atom
+        atom_template = pdbline.replace('%5i', '%5s').replace('%4i', '%4s') + '\n'
+        return ''.join(
+            atom_template % (serial.decode(), atname[:4], resname[:3], "",
+                             resid.decode(), '', x, y, z, 0, 0, '')
+            for serial, atname, resname, resid, x, y, z in zip(
+                serials.view('S5').ravel(), block.names, resnames,
+                resids.view('S4').ravel(), *coord.T.tolist())
+        )
+    return np.concatenate(columns, axis=1).tobytes().decode()
+
+
+def write_pdb(outfile, title, atoms, box, chunk=100000):
     """
     Write a PDB file.
 
@@ -376,9 +990,12 @@ def write_pdb(outfile, title, atoms, box):
     title
         The title of the GRO file. Must be a single line.
     atoms
-        An instance of Structure containing the atoms to write.
+        An instance of Structure (or StructureChain) containing the atoms
+        to write.
     box
         The periodic box as a 3x3 matrix.
+    chunk
+        The number of atoms formatted and written at once.
     """
     # Print the title
     print('TITLE ' + title, file=outfile)
@@ -387,19 +1004,208 @@ def write_pdb(outfile, title, atoms, box):
     print(pdbBoxString(box), file=outfile)
 
     # Print the atoms
-    for idx, atname, resname, resid, x, y, z in atoms:
-        print(pdbline % (idx % 1e5, atname[:4], resname[:3], "",
-                         resid % 1e4, '', 10*x, 10*y, 10*z, 0, 0, ''),
-              file=outfile)
+    first = 1
+    for block in structure_blocks(atoms):
+        for start in range(0, len(block), chunk):
+            part = block[start:start+chunk] if len(block) > chunk else block
+            outfile.write(pdb_lines(part, first))
+            first += len(part)
+
 
+def write_npz(filename, title, atoms, box, molecules=()):
+    """
+    Write a binary snapshot of a system, in numpy's npz layout.
 
-def write_structure(output, title, atoms, box):
-    oStream = output and open(output, "w") or sys.stdout
+    The coordinates are stored as float32, the names, residue names and
+    chains as tables with codes per atom. The box and the list of molecules
+    are stored as well, so that the system can be read back with Structure
+    without parsing text.
+    """
+    structure = Structure.concatenate(structure_blocks(atoms))
+    molecules = list(molecules)
+    np.savez(
+        filename,
+        title=np.array(title),
+        coord=structure.coord.astype(np.float32),
+        resids=structure.resids.astype(np.int32),
+        names=structure.names.codes, name_table=np.array(structure.names.table, dtype=str),
+        resnames=structure.resnames.codes, resname_table=np.array(structure.resnames.table, dtype=str),
+        chains=structure.chains.codes, chain_table=np.array(structure.chains.table, dtype=str),
+        box=np.asarray(box, dtype=float).reshape((3, 3)),
+        molecule_names=np.array([str(name) for name, _ in molecules], dtype=str),
+        molecule_counts=np.array([count for _, count in molecules], dtype=np.int64),
+    )
+
+
+COMPRESSORS = {
+    '.gz': gzip.open,
+    '.bz2': bz2.open,
+    '.xz': lzma.open,
+}
+
+
+class CompressedOutput(object):
+    """
+    Text output compressed in a background thread.
+
+    The chunks written are handed over to a thread that encodes and
+    compresses them, so that the compression overlaps with formatting the
+    next chunks. At most *ahead* chunks are kept waiting.
+    """
+    def __init__(self, filename, opener, ahead=8):
+        self.stream = opener(filename, 'wb')
+        self.chunks = queue.Queue(ahead)
+        self.error  = None
+        self.thread = threading.Thread(target=self._compress, daemon=True)
+        self.thread.start()
+
+    def _compress(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is None:
+                break
+            if self.error is None:
+                try:
+                    self.stream.write(chunk.encode())
+                except Exception as error:
+                    self.error = error
+
+    def write(self, text):
+        if self.error is not None:
+            raise self.error
+        self.chunks.put(text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.thread.is_alive():
+            self.chunks.put(None)
+            self.thread.join()
+            self.stream.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_output(output):
+    """
+    Open a file for writing text, compressed in the background if the
+    extension is one of COMPRESSORS.
+    """
+    base, extension = os.path.splitext(output)
+    if extension in COMPRESSORS:
+        return CompressedOutput(output, COMPRESSORS[extension])
+    return open(output, "w")
+
+
+class StructureWriter(object):
+    """
+    Structure output written by a background thread, while the rest of the
+    system is still being built.
+
+    The parts given to write are written in order. For GRO files, the
+    number of atoms is only known at the end, so a field of COUNT_WIDTH
+    characters (up to ten digits) is reserved in the header. The count is
+    written at the start of the field, formatted as by write_gro, and the
+    rest of the field is left blank.
+    """
+    COUNT_WIDTH = 10
+
+    def __init__(self, output, title, box, chunk=100000):
+        self.output = output
+        self.gro    = output.endswith(".gro")
+        self.stream = open_output(output)
+        self.title  = title[:80]
+        self.box    = box.tolist()
+        self.chunk  = chunk
+        self.count  = 0
+        self.parts  = queue.Queue()
+        self.error  = None
+        self.thread = threading.Thread(target=self._write, daemon=True)
+        self.thread.start()
+
+    @staticmethod
+    def supports(output):
+        """
+        Whether a file can be written in the background. GRO files need to
+        be seekable to set the number of atoms.
+        """
+        base, extension = os.path.splitext(output)
+        return (output.endswith(".gro") or output.endswith(".pdb")
+                or (extension in COMPRESSORS and base.endswith(".pdb")))
+
+    def _write(self):
+        try:
+            if self.gro:
+                print(self.title, file=self.stream)
+                self.count_offset = self.stream.tell()
+                print(" " * self.COUNT_WIDTH, file=self.stream)
+                lines = gro_lines
+            else:
+                print('TITLE ' + self.title, file=self.stream)
+                print(pdbBoxString(self.box), file=self.stream)
+                lines = pdb_lines
+            for atoms in iter(self.parts.get, None):
+                for block in structure_blocks(atoms):
+                    for start in range(0, len(block), self.chunk):
+                        part = block[start:start+self.chunk] if len(block) > self.chunk else block
+                        self.stream.write(lines(part, self.count + 1))
+                        self.count += len(part)
+            if self.gro:
+                print(groBoxString(self.box), file=self.stream)
+                self.stream.seek(self.count_offset)
+                self.stream.write("{:5d}".format(self.count).ljust(self.COUNT_WIDTH))
+        except Exception as error:
+            self.error = error
+
+    def write(self, atoms):
+        """
+        Queue a Structure, StructureChain or solvent lattice for writing.
+        """
+        self.parts.put(atoms)
+
+    def close(self):
+        """
+        Wait for all atoms to be written and close the file.
+        """
+        self.parts.put(None)
+        self.thread.join()
+        self.stream.close()
+        if self.error is not None:
+            raise self.error
+
+    def abort(self):
+        """
+        Stop writing, close the file and remove the partial output.
+        """
+        self.parts.put(None)
+        self.thread.join()
+        self.stream.close()
+        os.remove(self.output)
+
+
+def write_structure(output, title, atoms, box, pool=None, molecules=()):
+    if output.endswith(".npz"):
+        write_npz(output, title, atoms, box, molecules)
+        return
     # The title is always truncated to 80 characters to avoid 
     # Gromacs (or other programs) choking on them.
+    if pool is not None and output.endswith(".gro") and len(atoms):
+        if write_gro_parallel(output, title[:80], atoms, box.tolist(), pool):
+            return
+    oStream = output and open_output(output) or sys.stdout
+    base, extension = os.path.splitext(output)
+    if extension not in COMPRESSORS:
+        base = output
     with oStream:
-        if output.endswith(".gro"):
+        if base.endswith(".gro"):
             write_gro(oStream, title[:80], atoms, box.tolist())
         else:
             write_pdb(oStream, title[:80], atoms, box.tolist())
-
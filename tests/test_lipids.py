@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test the lipid templates.
+"""
+
+import numpy as np
+
+from insane.lipids import Lipid
+
+
+def _lipid():
+    return Lipid(name='DPPC', head=['C', 'P'], link=['G', 'G'], tail=['CCCC', 'CCCC'])
+
+
+def test_compiled_is_cached():
+    lipid = _lipid()
+    template = lipid.compiled(diam=0.8)
+    assert lipid.compiled(diam=0.8) is template
+    assert lipid.compiled(diam=0.6) is not template
+    assert not template.xy.flags.writeable
+
+
+def test_build_does_not_drift():
+    lipid = _lipid()
+    first = lipid.build(diam=0.8)
+    lipid.build(diam=0.6)
+    assert lipid.build(diam=0.8) == first
+    assert first[0][0] == 'NC3'
+    assert min(bead[3] for bead in first) == 0
+
+
+def test_compiled_radius():
+    xy = _lipid().compiled(diam=0.8).xy
+    low = xy.min(axis=0)
+    assert np.isclose(np.sqrt((low**2).sum()), 0.8*0.45)
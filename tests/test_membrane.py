@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test the grids used for placing lipids.
+"""
+
+import numpy as np
+from nose.tools import assert_raises
+
+import insane.core
+
+
+def _grid(rows):
+    return np.array([[cell != '#' for cell in row] for row in rows.split()])
+
+
+def test_enclosed_ring():
+    free = _grid('''
+        ........
+        ..####..
+        ..#..#..
+        ..#.##..
+        ..###...
+        ........
+    ''')
+    expected = np.zeros_like(free)
+    expected[2, 3:5] = expected[3, 3] = True
+    assert np.array_equal(insane.core.enclosed(free), expected)
+
+
+def test_enclosed_across_edges():
+    # A ring around the corner of the box, and a concave protein
+    free = _grid('''
+        .#...#.#
+        ##...###
+        ........
+        ...###..
+        ...#....
+        ##...###
+    ''')
+    expected = np.zeros_like(free)
+    expected[0, 0] = expected[0, 6] = True
+    assert np.array_equal(insane.core.enclosed(free), expected)
+
+
+def test_label_cells_fallback():
+    free = np.random.default_rng(1).random((30, 40)) < 0.6
+    ndimage = insane.core.ndimage
+    try:
+        insane.core.ndimage = None
+        labels, num = insane.core.label_cells(free)
+    finally:
+        insane.core.ndimage = ndimage
+    assert labels[free].min() == 1 and labels[free].max() == num
+    assert np.all(labels[~free] == 0)
+    # Neighbouring free cells share the label
+    both = free[1:] & free[:-1]
+    assert np.all(labels[1:][both] == labels[:-1][both])
+    both = free[:, 1:] & free[:, :-1]
+    assert np.all(labels[:, 1:][both] == labels[:, :-1][both])
+
+
+
+def test_hole_cells():
+    pbc = insane.core.PBC(shape='rectangular', box=[10, 0, 0, 0, 10, 0, 0, 0, 10])
+    # Cells of 1 nm, with the lipids at 0.5, 1.5, ... nm
+    assert insane.core.hole_cells([[3, 3], [0.9, 9.5]], (10, 10), pbc) == [(3, 3), (0, 9)]
+    assert_raises(ValueError, insane.core.hole_cells, [3.0], (10, 10), pbc)
+
+
+def test_hole_mask():
+    mask = insane.core.hole_mask((10, 10), 0, [(0, 0), (5, 5)], 2)
+    holes = ~mask
+    assert holes[0, 0] and holes[9, 9] and holes[5, 5] and holes[4, 6]
+    assert holes.sum() == 2 * 9
+
+
+def test_hole_mask_hexagonal():
+    # Across the sheared edge, the image of the center is at (5, 8)
+    mask = insane.core.hole_mask((10, 8), 5, [(0, 0)], 1.5)
+    holes = {(0, 0), (1, 0), (9, 0), (0, 1), (1, 1), (9, 1), (4, 7), (5, 7), (6, 7)}
+    assert set(zip(*np.nonzero(~mask))) == holes
@@ -22,6 +22,10 @@
 Test PBC related functions.
 """
 
+import itertools
+
+import numpy as np
+
 import insane
 
 
@@ -53,3 +57,41 @@ def test_invalid_pbc_shape():
         for shape in shapes:
             yield try_shape, shape
             
+
+
+def test_fractional_roundtrip():
+    pbc = insane.pbc.PBC(box=[5, 0, 0, 2.5, 4, 0, 1, 1, 6])
+    coord = np.array([[1, 2, 3], [8.5, 5, 6], [-1, -2, -3]])
+    fractional = pbc.to_fractional(coord)
+    assert np.allclose(fractional[1], (1, 1, 1))
+    assert np.allclose(pbc.to_cartesian(fractional), coord)
+
+
+def test_wrap():
+    pbc = insane.pbc.PBC(box=[5, 0, 0, 2.5, 4, 0, 1, 1, 6])
+    coord = np.array([[1, 2, 3], [7.5, 4.5, 6.5], [-1, -2, -3], [11, 2, 3]])
+    wrapped = pbc.wrap(coord)
+    assert np.all((wrapped >= 0) & (wrapped < (5, 4, 6)))
+    # The shifts are combinations of box vectors
+    shifts = np.linalg.solve(pbc.box.T, (coord - wrapped).T).T
+    assert np.allclose(shifts, np.round(shifts))
+    assert np.allclose(wrapped[0], coord[0])
+
+
+def test_distance():
+    pbc = insane.pbc.PBC(box=[10, 0, 0, 5, 8, 0, 0, 0, 10])
+    points = np.array([[1, 1, 0], [9, 1, 0], [6, 7.5, 0], [5, 4, 9]])
+    distance = pbc.distance(points, (0, 0, 0))
+    # The last point is closest to the image at (5, 8, 10)
+    assert np.allclose(distance**2, [2, 2, 1.25, 17])
+
+
+def test_distance_hexagonal():
+    # Reducing one box vector at a time misses the shortest image for
+    # points far apart in a hexagonal box
+    pbc = insane.pbc.PBC(box=[10, 0, 0, 5, 10*np.sqrt(0.75), 0, 0, 0, 10])
+    a = pbc.to_cartesian(np.random.RandomState(1).random_sample((1000, 3)))
+    b = pbc.to_cartesian(np.random.RandomState(2).random_sample((1000, 3)))
+    shifts = np.array(list(itertools.product((-2, -1, 0, 1, 2), repeat=3))) @ pbc.box
+    expected = np.sqrt((((a - b)[:, None] + shifts)**2).sum(axis=-1)).min(axis=1)
+    assert np.allclose(pbc.distance(a, b), expected)
@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test the random streams of the builders.
+"""
+
+import numpy as np
+
+from insane.core import (random_generator, build_solvent_block, SolventLattice,
+                         BLOCK_STREAM, LIPID_STREAM)
+
+
+def test_streams_reproducible():
+    first = random_generator(LIPID_STREAM, 0).random(10)
+    random_generator(LIPID_STREAM, 1).random(10)
+    assert np.all(random_generator(LIPID_STREAM, 0).random(10) == first)
+    assert not np.all(random_generator(LIPID_STREAM, 1).random(10) == first)
+    assert not np.all(random_generator(LIPID_STREAM, 0, seed=1).random(10) == first)
+
+
+def test_solvent_blocks_any_order():
+    labels = np.zeros((4, 4, 6), dtype=np.int8)
+    labels[:, :, ::2] = 1
+    lattice = SolventLattice(labels, (0.5, 0.5, 0.5), ['W', 'NA'], 0.1, layers=2)
+    blocks = [block.coord for block in lattice.blocks()]
+    jobs = list(lattice.jobs())
+    assert all(job[-2][0] == BLOCK_STREAM for job in jobs)
+    for job, coord in reversed(list(zip(jobs, blocks))):
+        assert np.all(build_solvent_block(*job).coord == coord)
@@ -180,7 +180,9 @@ def _run_internal(arguments):
     command = [INSANE] + arguments
     out = StringIO()
     err = StringIO()
-    with mock.patch('random.random', return_value=0.1):
+    with mock.patch('random.random', return_value=0.1), \
+         mock.patch('insane.core.random_generator',
+                    return_value=utils.ConstantGenerator(0.1)):
         with utils._redirect_out_and_err(out, err):
             returncode = insane.cli.main(command)
     out = out.getvalue()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test that the solvent does not depend on the way it is built.
+"""
+
+import io
+import os
+
+import mock
+import numpy as np
+from nose.tools import assert_raises
+
+import insane.cli
+import insane.structure
+import utils
+from insane.core import (closest_contact, grid_columns, pointsOnSphere,
+                         profile_exclusion, stamp_kernel, tile_solvent_box)
+from insane.pbc import PBC
+from insane.structure import Structure
+
+ARGUMENTS = ['insane', '-x', '6', '-y', '6', '-z', '7', '-l', 'POPC',
+             '-sol', 'W', '-salt', '0.15']
+
+
+def _build(*arguments):
+    """
+    Run insane in the current directory and return the content of the
+    GRO file written.
+    """
+    out, err = io.StringIO(), io.StringIO()
+    # Small slabs, to have many solvent blocks
+    with mock.patch('insane.core.SLAB_CELLS', 200), \
+         utils._redirect_out_and_err(out, err):
+        assert insane.cli.main(ARGUMENTS + ['-o', 'out.gro'] + list(arguments)) == 0
+    with open('out.gro') as infile:
+        return infile.read()
+
+
+def test_workers_same_output():
+    with utils.tempdir():
+        serial = _build('-nt', '1')
+        parallel = _build('-nt', '3')
+    assert serial == parallel
+
+
+def test_single_pool():
+    # All parallel steps of a run share one process pool
+    with utils.tempdir(), mock.patch('insane.structure._POOL', None), \
+         mock.patch('insane.structure.ProcessPool', wraps=insane.structure.ProcessPool) as pool:
+        _build('-nt', '3', '-stream')
+    assert pool.call_count == 1
+
+
+def test_stream_same_output():
+    with utils.tempdir():
+        built = _build()
+        streamed = _build('-stream')
+        streamed_parallel = _build('-stream', '-nt', '3')
+    assert built == streamed == streamed_parallel
+
+
+def test_pipeline_solvent_error():
+    # The output written in the background is removed if the solvent fails
+    with utils.tempdir():
+        with mock.patch('insane.core.setup_solvent', side_effect=ValueError('solvent')), \
+             mock.patch('insane.core.StructureWriter.abort', autospec=True,
+                        side_effect=insane.core.StructureWriter.abort) as abort:
+            with assert_raises(ValueError):
+                _build('-pipe')
+        assert abort.call_count == 1
+        assert not abort.call_args[0][0].thread.is_alive()
+        assert not os.path.exists('out.gro')
+
+
+def test_tile_solvent_box_boundary():
+    # A lattice of 7x7x7 beads 0.443 nm apart, which does not fit the cell
+    spacing = 3.1 / 7
+    solbox = Structure()
+    solbox.atoms = [('W', 'W', i + 1, ' ') + tuple(spacing * np.array(point))
+                    for i, point in enumerate(np.ndindex(7, 7, 7))]
+    solbox.box = [3.1, 0, 0, 0, 3.1, 0, 0, 0, 3.1]
+    for box in ([10, 0, 0, 0, 10, 0, 0, 0, 10], [10, 0, 0, 5, 8.66, 0, 0, 0, 10]):
+        pbc = PBC(box=box)
+        grid = np.ones((20, 20, 20), dtype=bool)
+        names, sizes, atnames, coord = tile_solvent_box(pbc, grid, solbox)
+        assert len(names) == len(coord) > 0.8 * 7**3 * pbc.box.diagonal().prod() / 3.1**3
+        assert closest_contact(coord, np.arange(len(coord)), pbc.box, 0.5) > spacing - 1e-6
+
+
+def test_grid_columns():
+    pbc = PBC(box=[10, 0, 0, 0, 10, 0, 0, 0, 10])
+    coord = np.array([[0.5, 0.5, 1], [2.5, 0.5, 1]])
+    columns = grid_columns((10, 10, 10), pbc, coord, margin=0)
+    assert np.flatnonzero(columns).tolist() == [0, 20]
+    columns = grid_columns((10, 10, 10), pbc, coord)
+    assert columns.sum() == 15 and columns[9, 9] and not columns[1, 2]
+    # Closing only fills the gap between the hits
+    columns = grid_columns((10, 10, 10), pbc, coord, close=True)
+    assert np.flatnonzero(columns).tolist() == [0, 10, 20]
+
+
+def test_profile_exclusion():
+    # A flat, dense slab of beads at a few heights, with a hole in the middle
+    pbc = PBC(box=[6, 0, 0, 0, 6, 0, 0, 0, 8])
+    x, y, z = np.meshgrid(np.arange(0, 6, 0.2), np.arange(0, 6, 0.2), [3.3, 3.8, 4.2, 4.7],
+                          indexing='ij')
+    coord = np.stack((x, y, z), axis=-1).reshape((-1, 3)) + 0.05
+    coord = coord[np.hypot(coord[:, 0] - 3, coord[:, 1] - 3) > 1.5]
+    kernel = 0.3 * pointsOnSphere(10)
+    shape = (12, 12, 16)
+    columns = grid_columns(shape, pbc, coord, close=True)
+    assert 0 < columns.sum() < 144
+    # The flagged cells cover all cells hit by the beads away from the edge
+    edge = ~columns
+    for axis in (0, 1):
+        edge = edge | np.roll(edge, 1, axis) | np.roll(edge, -1, axis)
+    inside = ~edge[tuple((2 * coord[:, :2]).astype(int).T)]
+    expected = stamp_kernel(np.ones(shape, dtype=bool), pbc, coord[inside], kernel)
+    grid = profile_exclusion(np.ones(shape, dtype=bool), pbc, coord[inside], kernel, columns)
+    assert not np.any(grid & ~expected)
+    assert np.all(grid[~columns] == expected[~columns])
+    # Layers that are not hit are left alone
+    assert grid[:, :, :5].all() and grid[:, :, 11:].all()
+
+
+def test_profile_exclusion_uncovered():
+    # Enough hits per layer on average, but only half of the columns are hit
+    pbc = PBC(box=[6, 0, 0, 0, 6, 0, 0, 0, 8])
+    x, y, z = np.meshgrid(np.arange(0.5, 3, 0.1), np.arange(0, 6, 0.1), [3.8, 4.2],
+                          indexing='ij')
+    coord = np.stack((x, y, z), axis=-1).reshape((-1, 3)) + 0.05
+    kernel = 0.2 * pointsOnSphere(10)
+    shape = (12, 12, 16)
+    columns = np.ones(shape[:2], dtype=bool)
+    expected = stamp_kernel(np.ones(shape, dtype=bool), pbc, coord, kernel)
+    assert expected[7:].all() and not expected[:6].all()
+    grid = profile_exclusion(np.ones(shape, dtype=bool), pbc, coord, kernel, columns)
+    assert np.all(grid == expected)
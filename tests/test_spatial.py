@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test the cell list neighbour search.
+"""
+
+import itertools
+
+import numpy as np
+
+from insane.spatial import CellList, count_within
+
+
+def _brute_force(queries, points, radius, box=None, images=2):
+    if box is None:
+        shifts = np.zeros((1, points.shape[1]))
+    else:
+        shifts = np.array(list(itertools.product(range(-images, images+1),
+                                                 repeat=points.shape[1]))) @ box
+    delta = queries[:, None, None] - points[None, :, None] - shifts[None, None]
+    return ((delta**2).sum(axis=3) < radius**2).sum(axis=(1, 2))
+
+
+def test_open_space():
+    rng = np.random.default_rng(1)
+    points = rng.random((300, 3)) * 5
+    queries = rng.random((200, 3)) * 7 - 1
+    assert np.all(count_within(queries, points, 0.8) ==
+                  _brute_force(queries, points, 0.8))
+
+
+def test_triclinic_box():
+    rng = np.random.default_rng(2)
+    box = np.array([[5, 0, 0], [2.5, 4.33, 0], [0, 0, 6]])
+    points = rng.random((300, 3)) @ box * 1.5 - 1
+    queries = rng.random((200, 3)) @ box * 2 - 2
+    assert np.all(count_within(queries, points, 1.3, box) ==
+                  _brute_force(queries, points, 1.3, box))
+
+
+def test_plane():
+    rng = np.random.default_rng(3)
+    box = np.array([[4, 0], [2, 3.5]])
+    points = rng.random((100, 2)) @ box
+    queries = rng.random((100, 2)) @ box
+    cells = CellList(points, 1.0, box)
+    assert np.all(cells.count(queries) == _brute_force(queries, points, 1.0, box))
+    assert np.all(cells.any(queries) == (cells.count(queries) > 0))
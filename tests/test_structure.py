@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# INSert membrANE
+# A simple, versatile tool for building coarse-grained simulation systems
+# Copyright (C) 2017  Tsjerk A. Wassenaar and contributors
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA  02110-1301, USA.
+
+"""
+Test the column storage of structures.
+"""
+
+import gzip
+import io
+import lzma
+import os
+
+import numpy as np
+
+import utils
+from insane.structure import (Categorical, ProcessPool, Structure, StructureChain,
+                              StructureWriter, format_decimals, groAtom, hybrid36, pdbAtom,
+                              process_pool, read_hybrid36, write_gro, write_gro_parallel,
+                              write_pdb, write_npz, write_structure)
+
+ATOMS = [
+    ('BB', 'LYS', 1, ' ', 0.0, 0.1, 0.2),
+    ('SC1', 'LYS', 1, ' ', 0.3, 0.4, 0.5),
+    ('BB', 'GLU', 2, ' ', 0.6, 0.7, 0.8),
+    ('PO4', 'DP.POPC', 3, ' ', 0.9, 1.0, 1.1),
+]
+
+GRO = """Test system
+    3
+    1LYS     BB    1   0.000   0.100   0.200
+    1LYS    SC1    2   0.300   0.400   0.500
+    2GLU     BB    3  12.600  -0.700   0.800
+   5.00000   5.00000   5.00000
+"""
+
+PDB = """TITLE     Test system
+CRYST1   50.000   50.000   50.000  90.00  90.00  90.00 P 1           1
+ATOM      1  BB  LYS A   1       0.000   1.000   2.000  1.00  0.00
+ATOM      2  SC1 LYS A   1       3.000   4.000   5.000  1.00  0.00
+HETATM    3  BB  GLU B   2     126.000  -7.000   8.000
+END
+"""
+
+
+def test_categorical_concatenate():
+    first = Categorical(['W', 'NA', 'W'])
+    second = Categorical(['CL', 'W'])
+    column = Categorical.concatenate([first, second])
+    assert column.tolist() == ['W', 'NA', 'W', 'CL', 'W']
+    assert list(column == 'W') == [True, False, True, False, True]
+
+
+def test_atoms_roundtrip():
+    structure = Structure()
+    structure.atoms = ATOMS
+    assert structure.atoms == ATOMS
+    assert structure.coord.shape == (4, 3)
+
+
+def test_concatenate():
+    structure = Structure()
+    structure.atoms = ATOMS
+    combined = Structure.concatenate([structure, Structure(), structure])
+    assert combined.atoms == ATOMS + ATOMS
+    assert np.all(combined.coord[4:] == structure.coord)
+
+
+def test_iter_strips_force_field():
+    structure = Structure()
+    structure.atoms = ATOMS
+    atoms = list(structure)
+    assert [atom[0] for atom in atoms] == [1, 2, 3, 4]
+    assert atoms[-1][2] == 'POPC'
+
+
+def test_charge():
+    structure = Structure()
+    structure.atoms = ATOMS
+    assert structure.charge == 0
+    structure.atoms = ATOMS[:2]
+    assert structure.charge == 1
+
+
+def test_residues():
+    structure = Structure()
+    structure.atoms = ATOMS
+    assert list(structure.residues) == [0, 2, 3]
+    structure.atoms = ATOMS[:1] + ATOMS[2:]
+    assert list(structure.residues) == [0, 1, 2]
+
+
+def test_charge_virtual_site():
+    structure = Structure()
+    structure.atoms = [('vS', 'LYS', 1, ' ', 0, 0, 0)] + ATOMS
+    assert structure.charge == -1
+
+
+def test_read_gro():
+    with utils.tempdir():
+        with open('test.gro', 'w') as outfile:
+            outfile.write(GRO)
+        structure = Structure('test.gro')
+    assert structure.atoms == [groAtom(line) for line in GRO.splitlines()[2:-1]]
+    assert structure.title == 'Test system\n'
+    assert structure.box[0] == 5
+
+
+def test_read_pdb():
+    with utils.tempdir():
+        with open('test.pdb', 'w') as outfile:
+            outfile.write(PDB)
+        structure = Structure('test.pdb')
+    assert structure.atoms == [pdbAtom(line) for line in PDB.splitlines()[2:-1]]
+    assert structure.title.startswith('TITLE')
+    assert structure.rest[-1] == 'END\n'
+
+
+def test_read_gzip():
+    with utils.tempdir():
+        with gzip.open('test.gro.gz', 'wt') as outfile:
+            outfile.write(GRO)
+        structure = Structure('test.gro.gz')
+    assert structure.atoms == [groAtom(line) for line in GRO.splitlines()[2:-1]]
+
+
+def test_format_decimals():
+    values = np.concatenate([np.linspace(-99.9995, 99.9995, 20001),
+                             [0.0, -0.0, -0.0004, 0.0005, 2.675, 9999.999]])
+    formatted = format_decimals(values, 8, 3).view('S8').ravel()
+    assert [value.decode() for value in formatted] == ['{:8.3f}'.format(value) for value in values]
+    assert format_decimals([-1000.0], 8, 3) is None
+
+
+def test_write_gro_chunks():
+    structure = Structure()
+    structure.atoms = ATOMS * 3 + [('LONGNAME', 'W', 123456, ' ', -1000.0, 0, 0)]
+    expected = io.StringIO()
+    print('Title\n   13', file=expected)
+    template = "{:5d}{:<5s}{:>5s}{:5d}{:8.3f}{:8.3f}{:8.3f}"
+    for idx, atname, resname, resid, x, y, z in StructureChain(structure):
+        print(template.format(resid % 100000, resname, atname, idx, x, y, z), file=expected)
+    print('{:10.5f}'.format(1) * 3 + '{:10.5f}'.format(0) * 6, file=expected)
+    for chunk in (2, 100):
+        output = io.StringIO()
+        write_gro(output, 'Title', StructureChain(structure[:12], structure[12:]), np.eye(3), chunk)
+        assert output.getvalue() == expected.getvalue()
+
+
+def test_hybrid36():
+    serials = hybrid36([1, 99999, 100000, 100001, 100000 + 26*36**4], 5)
+    assert serials.view('S5').ravel().tolist() == [b'    1', b'99999', b'A0000', b'A0001', b'a0000']
+    resids = hybrid36([9999, 10000, 10035, 10036, -5, -999], 4)
+    assert resids.view('S4').ravel().tolist() == [b'9999', b'A000', b'A00Z', b'A010', b'  -5', b'-999']
+
+
+def test_read_hybrid36():
+    values = np.array([-999, -5, 0, 9999, 10000, 10036, 10000 + 26*36**3, 10000 + 52*36**3 - 1])
+    assert np.all(read_hybrid36(hybrid36(values, 4).view('S4').ravel()) == values)
+
+
+def test_pdb_roundtrip():
+    structure = Structure()
+    structure.atoms = ATOMS + [('W', 'W', 10000, ' ', 1, 2, 3), ('W', 'W', -3, ' ', 1, 2, 3)]
+    with utils.tempdir():
+        write_structure('test.pdb', 'Title', structure, np.eye(3))
+        read = Structure('test.pdb')
+    assert read.resids.tolist() == [1, 1, 2, 3, 10000, -3]
+
+
+def test_write_pdb():
+    structure = Structure()
+    structure.atoms = ATOMS + [('W', 'W', 10000, ' ', 1, 2, 3)]
+    output = io.StringIO()
+    write_pdb(output, 'Title', structure, np.eye(3).tolist(), chunk=2)
+    lines = output.getvalue().splitlines(True)
+    assert lines[0] == 'TITLE Title\n'
+    assert lines[2] == 'ATOM      1 BB    LYS    1       0.000   1.000   2.000  0.00  0.00' + ' '*14 + '\n'
+    assert lines[5][17:26] == ' POP    3'
+    assert lines[6][17:26] == '   W A000'
+    assert [line[6:11] for line in lines[2:]] == ['    1', '    2', '    3', '    4', '    5']
+
+
+def test_write_gro_parallel():
+    structure = Structure()
+    structure.atoms = ATOMS * 5
+    expected = io.StringIO()
+    write_gro(expected, 'Title', structure, np.eye(3))
+    with utils.tempdir(), ProcessPool(2) as pool:
+        assert write_gro_parallel('test.gro', 'Title', structure, np.eye(3), pool, chunk=3)
+        with open('test.gro') as infile:
+            assert infile.read() == expected.getvalue()
+        # Lines that are too wide can not be put in place
+        structure.atoms = ATOMS + [('W', 'W', 5, ' ', 12345.0, 0, 0)]
+        assert not write_gro_parallel('test.gro', 'Title', structure, np.eye(3), pool, chunk=3)
+
+
+def test_process_pool():
+    assert process_pool(1) is None
+    pool = process_pool(2)
+    assert pool.workers == 2 and process_pool(2) is pool
+    # Another number of workers replaces the pool
+    other = process_pool(3)
+    assert other is not pool and other.workers == 3
+    assert process_pool(3) is other
+
+
+def test_write_compressed():
+    structure = Structure()
+    structure.atoms = ATOMS
+    with utils.tempdir():
+        write_structure('test.gro', 'Title', structure, np.eye(3))
+        write_structure('test.gro.gz', 'Title', structure, np.eye(3))
+        write_structure('test.pdb.xz', 'Title', structure, np.eye(3))
+        with gzip.open('test.gro.gz', 'rt') as infile, open('test.gro') as plain:
+            assert infile.read() == plain.read()
+        with lzma.open('test.pdb.xz', 'rt') as infile:
+            assert infile.read().startswith('TITLE Title')
+
+
+def test_npz_roundtrip():
+    structure = Structure()
+    structure.atoms = ATOMS
+    box = np.diag([5.0, 6.0, 7.0])
+    with utils.tempdir():
+        write_npz('system.npz', 'Title', StructureChain(structure, structure), box, [('POPC', 2)])
+        snapshot = Structure('system.npz')
+    assert snapshot.names.tolist() == structure.names.tolist() * 2
+    assert snapshot.resnames.tolist() == structure.resnames.tolist() * 2
+    assert np.allclose(snapshot.coord[4:], structure.coord)
+    assert snapshot.box == (5, 0, 0, 0, 6, 0, 0, 0, 7)
+    assert snapshot.molecules == [('POPC', 2)]
+    assert snapshot.title == 'Title'
+
+
+def test_structure_writer():
+    structure = Structure()
+    structure.atoms = ATOMS
+    expected = io.StringIO()
+    write_gro(expected, 'Title', StructureChain(structure, structure), np.eye(3))
+    with utils.tempdir():
+        writer = StructureWriter('test.gro', 'Title', np.eye(3), chunk=3)
+        writer.write(structure)
+        writer.write(structure)
+        writer.close()
+        with open('test.gro') as infile:
+            lines = infile.readlines()
+    expected = expected.getvalue().splitlines(True)
+    # The count is padded to the width reserved for it
+    assert lines[1] == expected[1].rstrip('\n').ljust(StructureWriter.COUNT_WIDTH) + '\n'
+    assert lines[:1] + lines[2:] == expected[:1] + expected[2:]
+
+
+def test_structure_writer_abort():
+    structure = Structure()
+    structure.atoms = ATOMS
+    with utils.tempdir():
+        writer = StructureWriter('test.gro', 'Title', np.eye(3))
+        writer.write(structure)
+        writer.abort()
+        assert not writer.thread.is_alive()
+        assert writer.stream.closed
+        assert not os.path.exists('test.gro')
+
+
+def test_structure_chain():
+    structure = Structure()
+    structure.atoms = ATOMS[:2]
+    chain = StructureChain(structure, Structure(), structure)
+    assert len(chain) == 4
+    assert chain and not StructureChain(Structure())
+    assert chain.charge == 2
+    assert [atom[0] for atom in chain] == [1, 2, 3, 4]
+    assert np.all(chain.coord == np.concatenate([structure.coord] * 2))
+    assert chain.coord is chain.coord
@@ -27,6 +27,8 @@ import shutil
 import sys
 import tempfile
 
+import numpy as np
+
 try:
     from StringIO import StringIO
 except ImportError:
@@ -78,6 +80,40 @@ class ContextStringIO(StringIO):
         pass
 
 
+class ConstantGenerator(object):
+    """
+    Stand-in for a numpy random generator that always draws the same value.
+
+    This is the array counterpart of mocking :func:`random.random` with a
+    constant return value: all the draws return *value*, and permutations
+    keep the original order.
+    """
+    def __init__(self, value):
+        self.value = value
+
+    def random(self, size=None):
+        """
+        Return *value*, or an array of *size* filled with *value*.
+        """
+        if size is None:
+            return self.value
+        return np.full(size, self.value)
+
+    def shuffle(self, x):
+        """
+        Leave the sequence in its original order.
+        """
+        pass
+
+    def permutation(self, x):
+        """
+        Return the identity permutation.
+        """
+        if isinstance(x, int):
+            return np.arange(x)
+        return np.array(x)
+
+
 @contextlib.contextmanager
 def in_directory(dirpath):
     return_dir = os.getcwd()